@@ -0,0 +1,310 @@
+import os
+import stat
+import mmap
+import copy
+import hashlib
+import logging
+import threading
+from functools import partial
+
+from crc32 import crc32_adapter
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# Size of the reads done by _read_chunks: files are read in a single chunk
+# of at least MIN_CHUNK_SIZE bytes, or in chunks of MAX_CHUNK_SIZE bytes
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+# Files of this size or bigger are hashed through a memory map by mmap_reader
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# Hash constructors by name. Any callable returning an object with the
+# hashlib update/digest interface can be registered
+HASHES = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'blake2b': hashlib.blake2b,
+    'crc32': crc32_adapter,
+}
+
+if xxhash is not None:
+    HASHES['xxhash'] = getattr(xxhash, 'xxh3_64', xxhash.xxh64)
+
+
+# One reusable read buffer per thread
+_buffers = threading.local()
+
+
+def _buffer(size):
+    if getattr(_buffers, 'size', 0) < size:
+        _buffers.view = memoryview(bytearray(size))
+        _buffers.size = size
+    return _buffers.view[:size]
+
+
+def _chunk_size(file_size):
+    return min(MAX_CHUNK_SIZE, max(MIN_CHUNK_SIZE, file_size))
+
+
+def _read_chunks(f, chunk_size=None, limit=None):
+    # Reads f with readinto into the buffer of the current thread. Every
+    # chunk is a memoryview over that buffer, only valid until the next chunk
+    # is read. f should be opened with buffering=0, so the data is read
+    # straight into the buffer
+    if chunk_size is None:
+        chunk_size = _chunk_size(os.fstat(f.fileno()).st_size)
+
+    view = _buffer(chunk_size)
+    while limit is None or limit > 0:
+        read = f.readinto(view if limit is None or limit >= chunk_size else view[:limit])
+        if not read:
+            return
+        if limit is not None:
+            limit -= read
+        yield view[:read]
+
+
+def _read_full(f, view):
+    # readinto until view is full or the file ends, so files of the same size
+    # are read in chunks of the same size
+    read = 0
+    while read < len(view):
+        size = f.readinto(view[read:])
+        if not size:
+            break
+        read += size
+    return read
+
+
+def compare_files(paths):
+    # Compares files of the same size byte by byte: they are read in lockstep
+    # and split on the first different chunk, so files that differ are
+    # usually rejected after their first chunk. Returns the lists of
+    # identical paths, a file that differs from every other is a list of its
+    # own. Files that can't be read aren't in any list
+    opened = []
+    try:
+        for path in paths:
+            try:
+                opened.append((path, open(path, 'rb', buffering=0)))
+            except:
+                logging.warning("Can't compare %s", path)
+
+        if not opened:
+            return []
+        chunk_size = _chunk_size(os.fstat(opened[0][1].fileno()).st_size)
+        buffers = dict((path, memoryview(bytearray(chunk_size))) for path, f in opened)
+
+        identical = []
+        pending = [opened]
+        while pending:
+            group = pending.pop()
+            if len(group) == 1:
+                identical.append([group[0][0]])
+                continue
+
+            # (chunk, members) of every different chunk read from the group
+            split = []
+            for path, f in group:
+                try:
+                    chunk = buffers[path][:_read_full(f, buffers[path])]
+                except:
+                    logging.warning("Can't compare %s", path)
+                    continue
+                for same in split:
+                    if same[0] == chunk:
+                        same[1].append((path, f))
+                        break
+                else:
+                    split.append((chunk, [(path, f)]))
+
+            for chunk, members in split:
+                if len(chunk):
+                    pending.append(members)
+                else:
+                    # every member ended at the same time
+                    identical.append([path for path, f in members])
+
+        return sorted(sorted(same) for same in identical)
+    finally:
+        for path, f in opened:
+            f.close()
+
+
+def hexdigest(digest):
+    # Digests are bytes from the hash functions to the repository, and hex
+    # only when they are shown. Anything else, like the labels of the files
+    # compared byte by byte, is shown as it is
+    return digest.hex() if isinstance(digest, bytes) else digest
+
+
+def parse_digest(text):
+    # the digest shown as text by hexdigest
+    try:
+        return bytes.fromhex(text)
+    except ValueError:
+        return text
+
+
+class FileShrunk(Exception):
+    pass
+
+
+class mmap_reader():
+    # Read strategy for checksum: regular files of threshold bytes or more
+    # are mapped in memory and handed to the hasher in MAX_CHUNK_SIZE slices,
+    # without copying them. Anything that can't be mapped is read with
+    # _read_chunks
+
+    def __init__(self, threshold=MMAP_THRESHOLD):
+        self.threshold = threshold
+
+    def __call__(self, f):
+        st = os.fstat(f.fileno())
+        if not stat.S_ISREG(st.st_mode) or st.st_size == 0 or st.st_size < self.threshold:
+            return _read_chunks(f, _chunk_size(st.st_size))
+
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            return _read_chunks(f, _chunk_size(st.st_size))
+
+        return self._slices(f, mapped)
+
+    def _slices(self, f, mapped):
+        with mapped, memoryview(mapped) as view:
+            if hasattr(mapped, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+
+            size = len(mapped)
+            for offset in range(0, size, MAX_CHUNK_SIZE):
+                # touching a page past the end of a truncated file raises
+                # SIGBUS, so the size is checked before every slice
+                if os.fstat(f.fileno()).st_size < size:
+                    raise FileShrunk(size)
+                with view[offset:offset + MAX_CHUNK_SIZE] as chunk:
+                    yield chunk
+
+
+class fadvise_policy():
+    # Page cache policy for checksum: files are read with
+    # POSIX_FADV_SEQUENTIAL and every consumed range is dropped from the page
+    # cache with POSIX_FADV_DONTNEED, so a scan doesn't evict the cache of
+    # everything else running on the machine. With prefetch=True, DupScanner
+    # asks for the next file in the queue with POSIX_FADV_WILLNEED.
+    # The counters are shared by all the workers
+
+    def __init__(self, prefetch=False):
+        self.prefetch = prefetch
+        self.dropped_bytes = 0
+        self.prefetched_bytes = 0
+        self.lock = threading.Lock()
+
+    def opened(self, f):
+        _fadvise(f.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+
+    def consumed(self, f, offset, length):
+        if _fadvise(f.fileno(), offset, length, 'POSIX_FADV_DONTNEED'):
+            with self.lock:
+                self.dropped_bytes += length
+
+    def closed(self, f):
+        # pages mapped by mmap_reader can't be dropped while they are mapped
+        _fadvise(f.fileno(), 0, 0, 'POSIX_FADV_DONTNEED')
+
+    def will_read(self, file_path):
+        if not self.prefetch:
+            return
+        try:
+            fd = os.open(file_path, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            if _fadvise(fd, 0, 0, 'POSIX_FADV_WILLNEED'):
+                with self.lock:
+                    self.prefetched_bytes += os.fstat(fd).st_size
+        finally:
+            os.close(fd)
+
+
+def _fadvise(fd, offset, length, advice):
+    # posix_fadvise is only available on some platforms
+    if not hasattr(os, 'posix_fadvise') or not hasattr(os, advice):
+        return False
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        return True
+    except OSError:
+        return False
+
+
+class checksum():
+    # Hash function for DupScanner built from the HASHES registry. algorithm
+    # identifies the digests it returns, including the digest size when it
+    # isn't the default one
+
+    def __init__(self, name='md5', digest_size=None, reader=_read_chunks, cache_policy=None):
+        # reader(f) yields the chunks of an unbuffered file, _read_chunks or
+        # mmap_reader
+        self.reader = reader
+        # cache_policy=fadvise_policy() keeps the scanned files out of the
+        # page cache
+        self.cache_policy = cache_policy
+
+        if name not in HASHES:
+            raise ValueError('Unknown hash algorithm {}, expected one of {}'.format(name, ', '.join(sorted(HASHES))))
+
+        if digest_size is None:
+            self.new = HASHES[name]
+            self.algorithm = name
+        else:
+            self.new = partial(HASHES[name], digest_size=digest_size)
+            self.algorithm = '{}-{}'.format(name, digest_size)
+
+        try:
+            self.new()
+        except (TypeError, ValueError) as e:
+            raise ValueError('Invalid digest size for {}: {}'.format(name, e))
+
+    def using(self, **kwargs):
+        # copy of this checksum with other attributes, e.g. using(reader=...)
+        other = copy.copy(self)
+        for name, value in kwargs.items():
+            setattr(other, name, value)
+        return other
+
+    def __call__(self, file_path):
+        try:
+            with open(file_path, 'rb', buffering=0) as f:
+                try:
+                    return self._digest(f, self.reader(f))
+                except FileShrunk:
+                    logging.info("%s shrank while it was hashed, reading it again", file_path)
+                    f.seek(0)
+                    return self._digest(f, _read_chunks(f))
+        except:
+            logging.warning("Can't calculate the %s checksum of %s", self.algorithm, file_path)
+            # Returning None to treat this files as unique
+            return None
+
+    def _digest(self, f, chunks):
+        m = self.new()
+        policy = self.cache_policy
+        if policy is None:
+            for chunk in chunks:
+                m.update(chunk)
+            return m.digest()
+
+        policy.opened(f)
+        offset = 0
+        for chunk in chunks:
+            m.update(chunk)
+            policy.consumed(f, offset, len(chunk))
+            offset += len(chunk)
+        policy.closed(f)
+
+        return m.digest()
@@ -0,0 +1,131 @@
+import os
+import zlib
+import struct
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from checksums import checksum, compare_files, mmap_reader, fadvise_policy, hexdigest, parse_digest, FileShrunk, \
+    HASHES, xxhash, _read_chunks
+
+
+class TestChecksum(unittest.TestCase):
+    def setUp(self):
+        self.root_path = tempfile.mkdtemp(prefix='checksums_test-')
+        self.data = os.urandom(3 * 4096 + 1)
+        self.file_path = os.path.join(self.root_path, 'a.data')
+        with open(self.file_path, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_path)
+
+    def test_algorithms(self):
+        expected = {
+            'md5': hashlib.md5(self.data).digest(),
+            'sha1': hashlib.sha1(self.data).digest(),
+            'blake2b': hashlib.blake2b(self.data).digest(),
+            'crc32': struct.pack('>I', zlib.crc32(self.data) & 0xffffffff),
+        }
+        if xxhash is not None:
+            expected['xxhash'] = HASHES['xxhash'](self.data).digest()
+
+        self.assertEqual(set(expected), set(HASHES))
+        for name, hash_value in expected.items():
+            self.assertEqual(hash_value, checksum(name)(self.file_path), name)
+
+    def test_digest_size(self):
+        blake2b = checksum('blake2b', 16)
+
+        self.assertEqual('blake2b-16', blake2b.algorithm)
+        self.assertEqual(hashlib.blake2b(self.data, digest_size=16).digest(), blake2b(self.file_path))
+        self.assertRaises(ValueError, checksum, 'md5', 16)
+        self.assertRaises(ValueError, checksum, 'blake2b', 65)
+
+    def test_hexdigest(self):
+        digest = checksum('md5')(self.file_path)
+
+        self.assertEqual(hashlib.md5(self.data).hexdigest(), hexdigest(digest))
+        self.assertEqual(digest, parse_digest(hexdigest(digest)))
+        self.assertEqual('compared-0', hexdigest('compared-0'))
+        self.assertEqual('compared-0', parse_digest('compared-0'))
+        self.assertIsNone(hexdigest(None))
+
+    def test_unknown_algorithm(self):
+        self.assertRaises(ValueError, checksum, 'md4')
+
+    def test_unreadable_file(self):
+        self.assertIsNone(checksum('md5')(os.path.join(self.root_path, 'missing.data')))
+
+    def test_read_chunks(self):
+        with open(self.file_path, 'rb', buffering=0) as f:
+            self.assertEqual(self.data, b''.join(bytes(chunk) for chunk in _read_chunks(f)))
+
+            f.seek(0)
+            chunks = [bytes(chunk) for chunk in _read_chunks(f, 4096)]
+            self.assertEqual([4096, 4096, 4096, 1], [len(chunk) for chunk in chunks])
+            self.assertEqual(self.data, b''.join(chunks))
+
+            f.seek(10)
+            chunks = [bytes(chunk) for chunk in _read_chunks(f, 4096, limit=5000)]
+            self.assertEqual([4096, 904], [len(chunk) for chunk in chunks])
+            self.assertEqual(self.data[10:5010], b''.join(chunks))
+
+    def test_mmap_reader(self):
+        mapped = checksum('md5', reader=mmap_reader(threshold=0))
+        self.assertEqual(hashlib.md5(self.data).digest(), mapped(self.file_path))
+
+        empty_path = os.path.join(self.root_path, 'empty.data')
+        open(empty_path, 'wb').close()
+        self.assertEqual(hashlib.md5().digest(), mapped(empty_path))
+
+        self.assertEqual(hashlib.md5(self.data).digest(), checksum('md5').using(reader=mmap_reader())(self.file_path))
+
+    def test_mmap_reader_shrunk_file(self):
+        big_path = os.path.join(self.root_path, 'big.data')
+        with open(big_path, 'wb') as f:
+            f.write(os.urandom(3 * 1024 * 1024))
+
+        with open(big_path, 'rb', buffering=0) as f:
+            chunks = mmap_reader(threshold=0)(f)
+            next(chunks)
+            os.truncate(big_path, 1024)
+            self.assertRaises(FileShrunk, next, chunks)
+
+    @unittest.skipUnless(hasattr(os, 'posix_fadvise'), 'posix_fadvise is not available')
+    def test_fadvise_policy(self):
+        policy = fadvise_policy(prefetch=True)
+
+        self.assertEqual(hashlib.md5(self.data).digest(), checksum('md5', cache_policy=policy)(self.file_path))
+        self.assertEqual(len(self.data), policy.dropped_bytes)
+
+        mapped = checksum('md5', reader=mmap_reader(threshold=0), cache_policy=policy)
+        self.assertEqual(hashlib.md5(self.data).digest(), mapped(self.file_path))
+        self.assertEqual(2 * len(self.data), policy.dropped_bytes)
+
+        policy.will_read(self.file_path)
+        self.assertEqual(len(self.data), policy.prefetched_bytes)
+
+    def _write(self, name, data):
+        file_path = os.path.join(self.root_path, name)
+        with open(file_path, 'wb') as f:
+            f.write(data)
+        return file_path
+
+    def test_compare_files(self):
+        same = self._write('same.data', self.data)
+        # same first chunk, the last byte differs
+        last = self._write('last.data', self.data[:-1] + bytes([self.data[-1] ^ 1]))
+        first = self._write('first.data', bytes([self.data[0] ^ 1]) + self.data[1:])
+        missing = os.path.join(self.root_path, 'missing.data')
+
+        self.assertEqual(
+            sorted([sorted([self.file_path, same]), [last], [first]]),
+            compare_files([self.file_path, last, same, first, missing])
+        )
+        self.assertEqual([[self.file_path]], compare_files([self.file_path]))
+        self.assertEqual([], compare_files([missing]))
+
+        empty = [self._write('empty%s.data' % i, b'') for i in range(3)]
+        self.assertEqual([sorted(empty)], compare_files(empty))
@@ -0,0 +1,78 @@
+#! /usr/bin/env python
+# Compares hashing a file with f.read() chunks and with _read_chunks
+# (readinto a reusable buffer) for chunk sizes from 4 KiB to 8 MiB.
+# The file is read once before timing, so it is served from the page cache
+# and the numbers show the per chunk cost rather than the disk speed.
+#
+#   python chunk_benchmark.py --size 256 --hash md5
+#   python chunk_benchmark.py --path /mnt/share/disk.img
+from __future__ import print_function
+
+import os
+import argparse
+import tempfile
+from timeit import default_timer
+
+from checksums import HASHES, _read_chunks
+
+CHUNK_SIZES = [4096 * 2 ** i for i in range(12)]  # 4 KiB .. 8 MiB
+
+
+def hash_read(new, file_path, chunk_size):
+    m = new()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def hash_readinto(new, file_path, chunk_size):
+    m = new()
+    with open(file_path, 'rb', buffering=0) as f:
+        for chunk in _read_chunks(f, chunk_size):
+            m.update(chunk)
+    return m.hexdigest()
+
+
+def run(reader, new, file_path, chunk_size, repeat):
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        reader(new, file_path, chunk_size)
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="Hash an existing file instead of a generated one")
+    parser.add_argument("--size", help="MiB in the generated file", type=int, default=64)
+    parser.add_argument("--hash", help="Hash algorithm", default='md5', choices=sorted(HASHES))
+    parser.add_argument("--repeat", help="Runs per chunk size, the best one is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    file_path = args.path
+    if not file_path:
+        fd, file_path = tempfile.mkstemp(prefix='chunk_benchmark-')
+        with os.fdopen(fd, 'wb') as f:
+            for _ in range(args.size):
+                f.write(os.urandom(1024 * 1024))
+
+    try:
+        new = HASHES[args.hash]
+        size = os.path.getsize(file_path) / (1024.0 * 1024.0)
+        assert hash_read(new, file_path, CHUNK_SIZES[0]) == hash_readinto(new, file_path, CHUNK_SIZES[0])
+
+        print('%10s %14s %14s' % ('chunk', 'read MiB/s', 'readinto MiB/s'))
+        for chunk_size in CHUNK_SIZES:
+            read = run(hash_read, new, file_path, chunk_size, args.repeat)
+            readinto = run(hash_readinto, new, file_path, chunk_size, args.repeat)
+            print('%9dK %14.1f %14.1f' % (chunk_size // 1024, size / read, size / readinto))
+    finally:
+        if not args.path:
+            os.remove(file_path)
+
+
+if '__main__' == __name__:
+    main()
@@ -1,18 +1,20 @@
 import zlib
-#import base64
+import struct
 
 
 class crc32_adapter():
-    block_size = 32
+    # hashlib like interface for zlib.crc32
+    block_size = 64
+    digest_size = 4
 
     def __init__(self):
-        self.accumulated = b''
+        self.accumulated = 0
 
     def update(self, data):
-        if self.accumulated == b'':
-            self.accumulated = zlib.adler32(data)
-        else:
-            self.accumulated = zlib.adler32(data, self.accumulated)
+        self.accumulated = zlib.crc32(data, self.accumulated)
+
+    def digest(self):
+        return struct.pack('>I', self.accumulated & 0xffffffff)
 
     def hexdigest(self):
-        return str(self.accumulated)
+        return '%08x' % (self.accumulated & 0xffffffff)
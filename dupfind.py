@@ -5,8 +5,12 @@ from __future__ import print_function
 import sys
 import argparse
 import logging
+from time import monotonic
+from contextlib import contextmanager
 
-from dupscanner import connection_factory, repository, DupScanner
+from dupscanner import connection_factory, repository, memory_repository, checksum_cache, DupScanner, parallel_walker, incremental_walker, \
+  _scandir_files, DB_PROFILES
+from checksums import checksum, mmap_reader, fadvise_policy, hexdigest, HASHES
 
 class file(object):
   """Factory for creating file object types
@@ -54,9 +58,10 @@ def pretty_print(results, output_file):
   prev_hash = None
   prev_size = None
 
-  for hash, size, filename, path, abspath, realpath in results:
+  for row in results:
+    hash, size, filename = row[:3]
     if prev_hash != hash or prev_size != size:
-      print(hash, size, sep='\t', file=output_file)
+      print(hexdigest(hash), size, sep='\t', file=output_file)
     print('\t%s' % filename, file=output_file)
     prev_hash = hash
     prev_size = size
@@ -65,10 +70,12 @@ def plain_print(template, results, output_file):
   from string import Template
   for row in results:
     ctx = dict(zip(row.keys(), row))
+    ctx['hash'] = hexdigest(ctx.get('hash'))
     print(Template(template).substitute(ctx))
 
 def exec_command(command, output_file, results):
   for hash, size, filename, path in results:
+    hash = hexdigest(hash)
     exec(command)
 
 def exec_script(script, output_file, results, conn, repo):
@@ -77,9 +84,42 @@ def exec_script(script, output_file, results, conn, repo):
   exec(command)
 
 
-def run_server(repo):
+@contextmanager
+def open_repository(database, backend, db_profile=None):
+  # (connection, repository) of the index, the memory backend has no
+  # connection
+  if backend == 'memory':
+    with memory_repository() as repo:
+      yield None, repo
+  else:
+    with connection_factory(database, db_profile) as conn, repository(conn) as repo:
+      yield conn, repo
+
+
+@contextmanager
+def open_cache(cache_file, db_profile=None):
+  if cache_file is None:
+    yield None
+  else:
+    with connection_factory(cache_file, db_profile) as conn, checksum_cache(conn) as cache:
+      yield cache
+
+
+def stream_files(clusters):
+  # the rows of the clusters yielded by DupScanner.iter_clusters, every file
+  # once, as soon as its cluster is confirmed
+  printed = {}
+  for found in clusters:
+    names = printed.setdefault((found.hash, found.size), set())
+    for row in found.files:
+      if row['fullname'] not in names:
+        names.add(row['fullname'])
+        yield row
+
+
+def run_server(repo, clusters=None):
   from web import create_server
-  server = create_server(repo)
+  server = create_server(repo, clusters)
   server.run(host='localhost', port=8080, debug=True, reloader=True)
 
 
@@ -88,11 +128,73 @@ def main():
   parser = argparse.ArgumentParser()
   parser.set_defaults(action='duplicates')
   parser.add_argument("path", help="Path where to look for duplicates", nargs='+')
-  parser.add_argument("-d", "--database", help="Stores a temporary SQLite database in a file", default=":memory:")
+  parser.add_argument("-d", "--database", help="Stores the index in a SQLite file, later runs only hash the files that changed", default=":memory:")
+  parser.add_argument(
+    "--db-profile",
+    help="""SQLite settings of the --database and --cache files: bulk-ingest for a fast index that can be built
+       again, durable for one that survives crashes, read-mostly for reports over an existing index (default: default)""",
+    default='default',
+    choices=sorted(DB_PROFILES)
+  )
+  parser.add_argument(
+    "--backend",
+    help="""Keeps the index in SQLite, or in Python dicts: memory is faster for a one-shot run, it can't be
+       used with --database, and scripts get no conn (default: sqlite)""",
+    default='sqlite',
+    choices=['sqlite', 'memory']
+  )
+  parser.add_argument("-c", "--cache", help="Keeps the checksums in a SQLite file and reuses them in later runs")
+  parser.add_argument("-j", "--threads", help="Threads listing directories concurrently (default: 1)", default=1, type=int)
+  parser.add_argument("--hash", help="Hash algorithm (default: md5)", default='md5', choices=sorted(HASHES))
+  parser.add_argument("--digest-size", help="Digest size in bytes, for blake2b", type=int)
+  parser.add_argument("--mmap-threshold", help="Hashes files of at least this many MiB through a memory map", type=int)
+  parser.add_argument(
+    "--cache-policy",
+    help="""Page cache use while hashing: keep (default), drop the hashed files from the cache,
+       or drop them and prefetch the next file""",
+    default='keep',
+    choices=['keep', 'drop', 'prefetch']
+  )
+  parser.add_argument("-w", "--workers", help="Threads reading and hashing files concurrently (default: 1)", default=1, type=int)
+  parser.add_argument(
+    "--max-inflight",
+    help="MiB of file contents being hashed at the same time by the workers (default: 64)",
+    default=64,
+    type=int
+  )
+  parser.add_argument(
+    "--compare",
+    help="""Compares the files of size groups of up to this many files byte by byte instead of hashing them.
+       Their hash is then a label shared by the identical files of the group (default: 0)""",
+    default=0,
+    type=int
+  )
+  parser.add_argument(
+    "--deadline",
+    help="""Stops hashing after this many seconds and reports the duplicates found so far. The groups that
+       may reclaim the most bytes are hashed first, and a later run with the same --database hashes the rest""",
+    type=float
+  )
+  parser.add_argument(
+    "-s",
+    "--stream",
+    help="Outputs every group of duplicates as soon as it is found, instead of after the scan",
+    action="store_true"
+  )
+  parser.add_argument(
+    "--pipeline",
+    help="Samples and hashes the files while the directories are still being walked",
+    action="store_true"
+  )
   parser.add_argument("-lf", "--log-format", help="Logging format", default='%(message)s')
   parser.add_argument("-l", "--log", help="File to output the log messages")
 #  parser.add_argument("-u", "--unique", help="Find unique files", action="store_const", const='unique', dest='action')
   parser.add_argument("-u", "--unique", help="Find unique files", action="store_true")
+  parser.add_argument(
+    "--skip-hardlinks",
+    help="Hardlinks to the same file aren't reported as duplicates, they are already deduplicated",
+    action="store_true"
+  )
   parser.add_argument("-o", "--output-file", help="Output file (default: stdout)", default='-', type=file('w', encoding='UTF-8'))
   g = parser.add_mutually_exclusive_group()
   g.add_argument(
@@ -135,6 +237,16 @@ def main():
     type=lambda level: level.upper()
   )
   args = parser.parse_args()
+  deadline = None if args.deadline is None else monotonic() + args.deadline
+  if args.backend == 'memory' and args.database != ':memory:':
+    parser.error('the memory backend keeps no --database file')
+  if args.stream and args.unique:
+    parser.error('unique files are only known after the scan, --stream only lists duplicates')
+
+  try:
+    hash_function = checksum(args.hash, args.digest_size)
+  except ValueError as e:
+    parser.error(str(e))
 
   logging.basicConfig(
     level=args.verbosity,
@@ -142,19 +254,54 @@ def main():
     filename=args.log
   )
 
+  cache_policy = {
+    'keep': None,
+    'drop': fadvise_policy(),
+    'prefetch': fadvise_policy(prefetch=True)
+  }[args.cache_policy]
+
   connection_string = args.database
   path = args.path
   action = args.action
   template = args.template
 
-  with connection_factory(connection_string) as conn, repository(conn) as repo, args.output_file as output_file:
-    dupscanner = DupScanner(repo)
+  with open_repository(connection_string, args.backend, args.db_profile) as (conn, repo), \
+      args.output_file as output_file, open_cache(args.cache, args.db_profile) as cache:
+    if args.threads > 1:
+      get_files = parallel_walker(args.threads)
+    elif connection_string != ':memory:':
+      # unchanged directories of a reused index aren't listed again
+      get_files = incremental_walker(repo)
+    else:
+      get_files = _scandir_files
+    dupscanner = DupScanner(
+      repo,
+      get_files=get_files,
+      hash_function=hash_function,
+      cache=cache,
+      workers=args.workers,
+      max_inflight_bytes=args.max_inflight * 1024 * 1024,
+      reader=None if args.mmap_threshold is None else mmap_reader(args.mmap_threshold * 1024 * 1024),
+      cache_policy=cache_policy,
+      pipeline=args.pipeline,
+      deadline=deadline,
+      compare_max_files=args.compare
+    )
 #    command = { 'unique': dupscanner.find_unique, 'duplicates': dupscanner.find_duplicates }
 
 #    results = command[action](path)
-    results = dupscanner.find_unique(path) if args.unique else dupscanner.find_duplicates(path)
+    if args.stream and args.interactive:
+      # the server scans while GET /clusters/stream is read
+      results = None
+    elif args.stream:
+      results = stream_files(dupscanner.iter_clusters(path, args.skip_hardlinks))
+    elif args.unique:
+      results = dupscanner.find_unique(path, args.skip_hardlinks)
+    else:
+      results = dupscanner.find_duplicates(path, args.skip_hardlinks)
 
     if args.execute_script: exec_script(args.execute_script, output_file, results, conn, repo)
+    elif args.interactive and args.stream: run_server(repo, dupscanner.iter_clusters(path, args.skip_hardlinks))
     elif args.interactive: run_server(repo)
     elif args.evaluate: func = exec_command(args.evaluate, output_file, results)
     elif args.pretty_print: func = pretty_print(results, output_file)
@@ -2,7 +2,26 @@ import os
 import hashlib
 import sqlite3
 import logging
+import threading
+from collections import deque, namedtuple
+from itertools import islice, groupby
+from operator import attrgetter
+from time import time_ns, perf_counter, monotonic
+from concurrent.futures import ThreadPoolExecutor
 from logtime import log_time
+from checksums import checksum, compare_files, _read_chunks
+
+try:
+    import queue
+except ImportError:
+    # python 2 compatibility
+    import Queue as queue
+
+try:
+    from os import scandir
+except ImportError:
+    # python 2 compatibility
+    from scandir import scandir
 
 
 def _get_files(path):
@@ -11,7 +30,7 @@ def _get_files(path):
             file_fullname = os.path.join(root, name)
             file_abspath = os.path.abspath(file_fullname)
             file_realpath = os.path.realpath(file_fullname)
-            file_size = _get_size(file_fullname)
+            file_stat = _get_stat(file_fullname)
 
             # This condition is assumed always true, and the queries may return
             # incorrect values if it evers turns out to be false
@@ -19,46 +38,300 @@ def _get_files(path):
             # assert file_realpath == file_abspath or os.path.islink(file_fullname), \
             # "%s is not %s and %s is not a symlink" % (file_realpath, file_abspath, file_fullname)
             if not os.path.islink(file_fullname):
-                yield (file_fullname, file_size, file_abspath, file_realpath)
+                yield (file_fullname, file_stat[0], file_abspath, file_realpath) + file_stat[1:]
+
+
+def _scandir_files(path):
+    # Same output as _get_files, but the file type, symlink status and size
+    # come from the DirEntry returned by scandir. realpath is only resolved
+    # for the root and for symlinked directories, every other path is built
+    # by joining the names to the parent directory
+    pending = [(path, os.path.abspath(path), os.path.realpath(path))]
+    while pending:
+        files, dirs, _ = _list_dir(*pending.pop())
+        for file_data in files:
+            yield file_data
+        # reversed, so the subdirectories are visited in listing order
+        pending.extend(reversed(dirs))
+
+
+def _list_dir(dir_fullname, dir_abspath, dir_realpath):
+    # Returns the files and the subdirectories of a directory, and whether
+    # it could be listed
+    files = []
+    dirs = []
+    try:
+        entries = list(scandir(dir_fullname))
+    except OSError:
+        logging.warning("Can't list the directory %s", dir_fullname)
+        return files, dirs, False
+
+    for entry in entries:
+        file_abspath = os.path.join(dir_abspath, entry.name)
+        try:
+            # follows symlinks, as os.walk(followlinks=True) does
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+
+        if is_dir:
+            if entry.is_symlink():
+                file_realpath = os.path.realpath(entry.path)
+            else:
+                file_realpath = os.path.join(dir_realpath, entry.name)
+            dirs.append((entry.path, file_abspath, file_realpath))
+        elif not entry.is_symlink():
+            file_realpath = os.path.join(dir_realpath, entry.name)
+            file_stat = _get_entry_stat(entry)
+            files.append((entry.path, file_stat[0], file_abspath, file_realpath) + file_stat[1:])
+
+    return files, dirs, True
+
+
+class parallel_walker():
+    # Same output as _scandir_files, but the directories are listed by a pool
+    # of threads, so there are several getdents/stat calls outstanding at once.
+    # ordered=True yields the files in the same order as _scandir_files,
+    # otherwise every directory is yielded as soon as it is listed
+
+    def __init__(self, threads=4, ordered=False):
+        self.threads = threads
+        self.ordered = ordered
+
+    def __call__(self, path):
+        executor = ThreadPoolExecutor(max_workers=self.threads)
+        listed = queue.Queue()
+        stopped = threading.Event()
+        submitted = [0]
+        lock = threading.Lock()
+
+        def submit(dir_data):
+            with lock:
+                submitted[0] += 1
+            future = executor.submit(list_dir, dir_data)
+            future.add_done_callback(listed.put)
+            return future
+
+        def list_dir(dir_data):
+            files, dirs, _ = _list_dir(*dir_data)
+            if stopped.is_set():
+                return files, []
+            return files, [submit(d) for d in dirs]
+
+        try:
+            root = submit((path, os.path.abspath(path), os.path.realpath(path)))
+            listings = self._ordered(root) if self.ordered else self._unordered(listed, submitted, lock)
+            for files in listings:
+                for file_data in files:
+                    yield file_data
+        finally:
+            # the consumer may stop early, don't list the rest of the tree
+            stopped.set()
+            executor.shutdown(wait=True)
+
+    def _ordered(self, root):
+        pending = [root]
+        while pending:
+            files, children = pending.pop().result()
+            yield files
+            pending.extend(reversed(children))
+
+    def _unordered(self, listed, submitted, lock):
+        # a directory is submitted before its parent listing completes, so
+        # the walk is over once every submitted listing has been consumed
+        consumed = 0
+        while True:
+            with lock:
+                if consumed == submitted[0]:
+                    return
+            files, _ = listed.get().result()
+            consumed += 1
+            yield files
 
 
-def _get_size(file_fullname):
+class incremental_walker():
+    # Same output as _scandir_files, plus the id of the directory of every
+    # file in the repository. Directories are recorded with their
+    # (st_dev, st_ino, mtime_ns), and a directory that didn't change since a
+    # finished scan isn't listed again: its file and subdirectory names come
+    # from the repository and only the files are stat'ed, to find the ones
+    # modified in place. Uses the repository from the calling thread
+
+    def __init__(self, repository):
+        self.repository = repository
+
+    def __call__(self, path):
+        started = time_ns()
+        pending = [(path, os.path.abspath(path), os.path.realpath(path), False, None)]
+        while pending:
+            dir_fullname, dir_abspath, dir_realpath, is_link, parent_id = pending.pop()
+            try:
+                st = os.stat(dir_fullname)
+            except OSError:
+                logging.warning("Can't list the directory %s", dir_fullname)
+                continue
+
+            stored = self.repository.find_directory(dir_abspath)
+            if stored is not None and tuple(stored[1:]) == (st.st_dev, st.st_ino, st.st_mtime_ns):
+                dir_id = self.repository.add_directory(
+                    dir_abspath, parent_id, st.st_dev, st.st_ino, st.st_mtime_ns, is_link)
+                files, dirs = self._stored_listing(dir_id, dir_fullname, dir_abspath, dir_realpath)
+            else:
+                files, dirs, listed = _list_dir(dir_fullname, dir_abspath, dir_realpath)
+                # A listing is only reused if the directory can't change
+                # again within the resolution of its mtime
+                reusable = listed and started - st.st_mtime_ns > RACY_MTIME_NS
+                dir_id = self.repository.add_directory(
+                    dir_abspath, parent_id, st.st_dev, st.st_ino, st.st_mtime_ns if reusable else None, is_link)
+                dirs = [
+                    (fullname, abspath, realpath, realpath != os.path.join(dir_realpath, os.path.basename(abspath)))
+                    for fullname, abspath, realpath in dirs
+                ]
+
+            for file_data in files:
+                yield file_data + (dir_id,)
+            # reversed, so the subdirectories are visited in listing order
+            pending.extend(dir_data + (dir_id,) for dir_data in reversed(dirs))
+
+    def _stored_listing(self, dir_id, dir_fullname, dir_abspath, dir_realpath):
+        files = []
+        for name in self.repository.findBy_directory(dir_id):
+            file_fullname = os.path.join(dir_fullname, name)
+            file_stat = _get_stat(file_fullname)
+            files.append((
+                file_fullname, file_stat[0], os.path.join(dir_abspath, name), os.path.join(dir_realpath, name)
+            ) + file_stat[1:])
+
+        dirs = []
+        for name, is_link in self.repository.findBy_parent_directory(dir_id):
+            fullname = os.path.join(dir_fullname, name)
+            realpath = os.path.realpath(fullname) if is_link else os.path.join(dir_realpath, name)
+            dirs.append((fullname, os.path.join(dir_abspath, name), realpath, is_link))
+
+        return files, dirs
+
+
+def _get_entry_stat(entry):
+    try:
+        return _stat_fields(entry.stat())
+    except OSError:
+        logging.warning("Can't calculate the size of %s", entry.path)
+        # Returning None to treat this files as unique
+        return None, None, None, None
+
+
+def _get_stat(file_fullname):
     try:
         # TODO: Investigate why some files aren't accesible
-        return os.path.getsize(file_fullname)
+        return _stat_fields(os.stat(file_fullname))
     except:
         logging.warning("Can't calculate the size of %s", file_fullname)
         # Returning None to treat this files as unique
-        return None
+        return None, None, None, None
+
+
+def _stat_fields(st):
+    # (size, mtime_ns, dev, ino). Some platforms report a zero inode, and
+    # the file is then only identified by its realpath
+    if not st.st_ino:
+        return st.st_size, st.st_mtime_ns, None, None
+    return st.st_size, st.st_mtime_ns, st.st_dev, st.st_ino
+
+
+_md5_checksum = checksum('md5')
 
 
-def _md5_checksum(file_path):
+# Rows inserted per transaction by repository.add_files
+BATCH_SIZE = 10000
+
+# Bytes of file contents being read at the same time by the checksum workers
+MAX_INFLIGHT_BYTES = 64 * 1024 * 1024
+
+# Bytes read from the head and from the tail of a file by _sample_checksum
+SAMPLE_SIZE = 4096
+
+# Files walked ahead of the inserts by DupScanner.insert_files_pipelined
+WALK_QUEUE_SIZE = 10000
+
+
+def _sample_checksum(file_path, sample_size=SAMPLE_SIZE):
     try:
-        #m = crc32_adapter()
         m = hashlib.md5()
-        with open(file_path, 'rb') as f:
-            # b'' == EOF
-            for chunk in iter(lambda: f.read(m.block_size * 64), b''):
+        with open(file_path, 'rb', buffering=0) as f:
+            for chunk in _read_chunks(f, sample_size, limit=sample_size):
+                m.update(chunk)
+            f.seek(-sample_size, os.SEEK_END)
+            for chunk in _read_chunks(f, sample_size, limit=sample_size):
                 m.update(chunk)
-                pass
-        hash_value = m.hexdigest()
 
-        return hash_value
+        return m.digest()
     except:
-        logging.warning("Can't calculate the md5 checksum of %s", file_path)
-        # Returning None to treat this files as unique
+        logging.warning("Can't calculate the sample checksum of %s", file_path)
+        # Returning None to keep the file as a candidate for the full checksum
+        return None
+
+
+def _cache_key(file_path):
+    try:
+        st = os.stat(file_path)
+        return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+    except OSError:
         return None
 
 
+# PRAGMAs set by connection_factory on connect, in this order. page_size
+# only applies to a new database, and must be set before it switches to WAL.
+# Negative cache sizes are in KiB
+DB_PROFILES = {
+    # SQLite's own defaults
+    'default': [],
+    # Building an index that can be built again: no fsync at all, a crash of
+    # the machine may lose or corrupt the last transactions
+    'bulk-ingest': [
+        ('page_size', 16384),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'OFF'),
+        ('cache_size', -256 * 1024),
+        ('mmap_size', 256 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ],
+    # An index kept across runs: every commit survives a crash of the machine
+    'durable': [
+        ('page_size', 4096),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'FULL'),
+        ('cache_size', -64 * 1024),
+        ('mmap_size', 0),
+        ('temp_store', 'FILE'),
+    ],
+    # Reports and the web server over an existing index
+    'read-mostly': [
+        ('page_size', 4096),
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -128 * 1024),
+        ('mmap_size', 1024 * 1024 * 1024),
+        ('temp_store', 'MEMORY'),
+    ],
+}
+
+
 class connection_factory():
 
-    def __init__(self, con_string):
+    def __init__(self, con_string, profile=None):
         self.con_str = con_string
         self.connection = None
+        # a name from DB_PROFILES, None keeps SQLite's defaults
+        if profile is not None and profile not in DB_PROFILES:
+            raise ValueError('Unknown database profile {}, expected one of {}'.format(
+                profile, ', '.join(sorted(DB_PROFILES))))
+        self.pragmas = DB_PROFILES[profile] if profile is not None else []
 
     def __enter__(self):
         self.connection = sqlite3.connect(self.con_str)
         self.connection.row_factory = sqlite3.Row
+        for name, value in self.pragmas:
+            self.connection.execute('PRAGMA {} = {}'.format(name, value))
 
         return self.connection
 
@@ -74,10 +347,238 @@ class connection_factory():
         return False
 
 
+# files.state: the last checksum stage a file went through. A file keeps
+# its state, so an interrupted or repeated scan doesn't process it again
+STATE_NEW = 0
+STATE_SAMPLED = 1
+STATE_HASHED = 2
+# compared byte by byte with the rest of its size group, see
+# DupScanner.compare_max_files. The hash is a label shared by the
+# identical files of the group
+STATE_COMPARED = 3
+
+# hash of the files compared byte by byte, by identical files in the group
+COMPARED_LABEL = 'compared-{}'
+
+# A directory modified this close to the start of a scan may change again
+# without changing its mtime, on filesystems with a coarse mtime resolution
+RACY_MTIME_NS = 2 * 10 ** 9
+
+# Schema changes, in order. PRAGMA user_version keeps how many of them have
+# been applied to a database, create_schema applies the rest
+SCHEMA_MIGRATIONS = [
+    [
+        'CREATE TABLE files('
+        '  fullname TEXT PRIMARY KEY, '
+        '  size INT, '
+        '  hash CHAR(32), '
+        '  sample CHAR(32), '
+        '  path TEXT, '
+        '  abspath TEXT, '
+        '  realpath TEXT'
+        ')'
+    ],
+    [
+        # (size, hash) also serves the lookups by size alone
+        'CREATE INDEX files_size_hash ON files(size, hash)',
+        'CREATE INDEX files_size_sample ON files(size, sample)',
+        'CREATE INDEX files_abspath ON files(abspath)',
+        'CREATE INDEX files_realpath ON files(realpath)',
+    ],
+    [
+        # covering indexes for the duplicate groups, count(distinct realpath)
+        # is computed without reading the table
+        'DROP INDEX files_size_hash',
+        'DROP INDEX files_size_sample',
+        'CREATE INDEX files_size_hash_realpath ON files(size, hash, realpath)',
+        'CREATE INDEX files_size_sample_realpath ON files(size, sample, realpath)',
+    ],
+    [
+        'ALTER TABLE files ADD COLUMN state INT NOT NULL DEFAULT {:d}'.format(STATE_NEW),
+        'UPDATE files SET state = {:d} WHERE sample IS NOT NULL'.format(STATE_SAMPLED),
+        'UPDATE files SET state = {:d} WHERE hash IS NOT NULL'.format(STATE_HASHED),
+    ],
+    [
+        # files.scan_id is the last scan that found the file on disk
+        'CREATE TABLE scans('
+        '  id INTEGER PRIMARY KEY, '
+        '  algorithm TEXT, '
+        '  started TIMESTAMP'
+        ')',
+        'ALTER TABLE files ADD COLUMN mtime_ns INT',
+        'ALTER TABLE files ADD COLUMN scan_id INT',
+    ],
+    [
+        # directories recorded by incremental_walker. A null mtime_ns means
+        # the listing can't be reused
+        'CREATE TABLE directories('
+        '  id INTEGER PRIMARY KEY, '
+        '  abspath TEXT UNIQUE, '
+        '  parent_id INT, '
+        '  dev INT, '
+        '  ino INT, '
+        '  mtime_ns INT, '
+        '  is_link INT, '
+        '  scan_id INT'
+        ')',
+        'CREATE INDEX directories_parent ON directories(parent_id)',
+        'ALTER TABLE files ADD COLUMN dir_id INT',
+        'CREATE INDEX files_dir ON files(dir_id)',
+        'ALTER TABLE scans ADD COLUMN finished TIMESTAMP',
+    ],
+    [
+        # hardlinks to the same inode share their sample and hash
+        'ALTER TABLE files ADD COLUMN dev INT',
+        'ALTER TABLE files ADD COLUMN ino INT',
+        'CREATE INDEX files_dev_ino ON files(dev, ino)',
+    ],
+    [
+        # samples and hashes are stored as BLOBs instead of hex digests, the
+        # CHAR(32) columns keep them as they are. The labels of the files
+        # compared byte by byte stay text
+        "UPDATE files SET sample = unhex(sample) WHERE typeof(sample) = 'text'",
+        "UPDATE files SET hash = unhex(hash) WHERE typeof(hash) = 'text' AND state <> {:d}".format(STATE_COMPARED),
+    ],
+    [
+        # files and directories are stored by the id of their directory and
+        # their name, see repository. The fullname and the realpath of a file
+        # are only stored when they can't be derived from its path
+        'ALTER TABLE files RENAME TO files_paths',
+        'ALTER TABLE directories RENAME TO directories_paths',
+        'CREATE TABLE roots('
+        '  id INTEGER PRIMARY KEY, '
+        '  path TEXT, '
+        '  abspath TEXT'
+        ')',
+        'CREATE TABLE directories('
+        '  id INTEGER PRIMARY KEY, '
+        '  parent_id INT, '
+        '  name TEXT NOT NULL, '
+        '  dev INT, '
+        '  ino INT, '
+        '  mtime_ns INT, '
+        '  is_link INT, '
+        '  scan_id INT'
+        ')',
+        'CREATE UNIQUE INDEX directories_parent_name ON directories(parent_id, name)',
+        'CREATE TABLE files('
+        '  id INTEGER PRIMARY KEY, '
+        '  dir_id INT NOT NULL, '
+        '  name TEXT NOT NULL, '
+        '  root_id INT, '
+        '  fullname TEXT, '
+        '  real_dir_id INT, '
+        '  real_name TEXT, '
+        '  size INT, '
+        '  hash BLOB, '
+        '  sample BLOB, '
+        '  state INT NOT NULL DEFAULT {:d}, '
+        '  mtime_ns INT, '
+        '  dev INT, '
+        '  ino INT, '
+        '  scan_id INT'
+        ')'.format(STATE_NEW),
+        'CREATE UNIQUE INDEX files_dir_name ON files(dir_id, name)',
+        lambda repository: repository._normalize_paths(),
+        'DROP TABLE files_paths',
+        'DROP TABLE directories_paths',
+        'CREATE INDEX files_fullname ON files(fullname) WHERE fullname IS NOT NULL',
+        'CREATE INDEX files_size_hash ON files(size, hash)',
+        'CREATE INDEX files_size_sample ON files(size, sample)',
+        'CREATE INDEX files_dev_ino ON files(dev, ino)',
+        'CREATE INDEX files_real_dir ON files(real_dir_id) WHERE real_dir_id IS NOT NULL',
+    ],
+]
+
+# A row s for the same contents as the row f: a hardlink to the same inode,
+# or the file itself
+SAME_INODE = 's.dev = {f}.dev and s.ino = {f}.ino and s.size = {f}.size and s.mtime_ns = {f}.mtime_ns'
+
+# files.real_dir_id of the files whose realpath isn't known
+NO_REALPATH = 0
+
+# The realpath of the row f, as the same text for every row with the same
+# realpath: the id of its directory and its name. real_dir_id and real_name
+# are only stored when the realpath isn't the abspath of the file. Null if
+# the realpath isn't known
+REALPATH = (
+    'nullif(coalesce({f}.real_dir_id, {f}.dir_id), %d)' % NO_REALPATH +
+    " || '/' || coalesce({f}.real_name, {f}.name)"
+)
+
+# the row f has a known realpath
+HAS_REALPATH = '{f}.real_dir_id is not %d' % NO_REALPATH
+
+# What makes two rows different files: their inode when it is known, so
+# hardlinks count as a single file, or their realpath
+FILE_IDENTITY = "coalesce({f}.dev || ':' || {f}.ino, " + REALPATH + ")"
+
+# the columns of the row f turned into its fullname, path and abspath by
+# repository._paths, they are always the last columns of the rows
+PATH_COLUMNS = '{f}.dir_id, {f}.name, {f}.root_id, {f}.fullname'
+
+
+def _unhex(value):
+    # unhex() for SQLite versions older than 3.41
+    return None if value is None else bytes.fromhex(value)
+
+
+def _fullname(path, path_abspath, abspath):
+    # the name of the file abspath found by walking path, whose abspath is
+    # path_abspath. None if the file isn't under path
+    if path is None or not abspath.startswith(path_abspath):
+        return None
+    relative = abspath[len(path_abspath):]
+    if not relative.startswith(os.sep) and not path_abspath.endswith(os.sep):
+        return None
+    return os.path.join(path, relative.lstrip(os.sep))
+
+
+class _row(tuple):
+    # A result row built in Python, read by position or by column name like
+    # a sqlite3.Row
+
+    __slots__ = ()
+    columns = ()
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = self.columns.index(key)
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return list(self.columns)
+
+    @classmethod
+    def of(cls, *columns):
+        return type('row', (cls,), {'__slots__': (), 'columns': columns})
+
+
+_file_row = _row.of('hash', 'size', 'fullname', 'path', 'abspath')
+_size_row = _row.of('size', 'fullname')
+_hash_size_row = _row.of('fullname', 'size', 'hash', 'path', 'abspath')
+_cluster_row = _row.of('hash', 'size', 'count(*)')
+_state_row = _row.of('state', 'sample')
+_directory_row = _row.of('id', 'dev', 'ino', 'mtime_ns')
+
+
 class repository():
+    # The files are stored by directory and name. The directories are a tree
+    # of (parent_id, name), and the paths given to the scans are in roots:
+    # the fullname, path and abspath of a file are rebuilt from them when a
+    # row is read, and the fullname and the realpath are only stored when
+    # they are something else
 
     def __init__(self, connection):
         self.connection = connection
+        # the scan in progress, see start_scan
+        self.scan_id = None
+        # the directories and the roots already read or written, by id and
+        # by path
+        self.directory_ids = {}
+        self.directory_paths = {}
+        self.root_ids = {}
+        self.root_paths = {}
 
     def __enter__(self):
         self.create_schema()
@@ -86,27 +587,162 @@ class repository():
     def __exit__(self, type, value, tb):
         self.connection = None
 
+    def commit(self):
+        self.connection.commit()
+
     def create_schema(self):
-        self.connection.execute(
-            'CREATE TABLE files('
-            '  fullname TEXT PRIMARY KEY, '
-            '  size INT, '
-            '  hash CHAR(32), '
-            '  path TEXT, '
-            '  abspath TEXT, '
-            '  realpath TEXT'
-            ')'
+        self.connection.create_function('unhex', 1, _unhex, deterministic=True)
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        for version, statements in enumerate(SCHEMA_MIGRATIONS[version:], version + 1):
+            logging.info('migrating the schema to version %s', version)
+            for statement in statements:
+                if callable(statement):
+                    statement(self)
+                else:
+                    self.connection.execute(statement)
+            self.connection.execute('PRAGMA user_version = {:d}'.format(version))
+
+    def _directory_id(self, abspath, create=True):
+        # the id of a directory, its parents are added with it. None if it
+        # isn't in the index and create is False
+        dir_id = self.directory_ids.get(abspath)
+        if dir_id is not None:
+            return dir_id
+
+        parent, name = os.path.split(abspath)
+        if parent == abspath:
+            parent_id, name = None, abspath
+        else:
+            parent_id = self._directory_id(parent, create)
+            if parent_id is None:
+                return None
+
+        row = self.connection.execute(
+            'select id from directories where parent_id is ? and name = ?', (parent_id, name)).fetchone()
+        if row is not None:
+            dir_id = row[0]
+        elif create:
+            dir_id = self.connection.execute(
+                'INSERT INTO directories(parent_id, name) VALUES(?,?)', (parent_id, name)).lastrowid
+        else:
+            return None
+
+        self.directory_ids[abspath] = dir_id
+        self.directory_paths[dir_id] = abspath
+        return dir_id
+
+    def _directory_path(self, dir_id):
+        abspath = self.directory_paths.get(dir_id)
+        if abspath is None:
+            parent_id, name = self.connection.execute(
+                'select parent_id, name from directories where id = ?', (dir_id,)).fetchone()
+            abspath = name if parent_id is None else os.path.join(self._directory_path(parent_id), name)
+            self.directory_paths[dir_id] = abspath
+            self.directory_ids[abspath] = dir_id
+        return abspath
+
+    def _root_id(self, path):
+        # (id, abspath) of a path given to a scan, relative paths are taken
+        # from the current directory
+        if path is None:
+            return None, None
+        root = self.root_ids.get(path)
+        if root is None:
+            abspath = os.path.abspath(path)
+            row = self.connection.execute(
+                'select id from roots where path = ? and abspath = ?', (path, abspath)).fetchone()
+            if row is not None:
+                root_id = row[0]
+            else:
+                root_id = self.connection.execute(
+                    'INSERT INTO roots(path, abspath) VALUES(?,?)', (path, abspath)).lastrowid
+            root = self.root_ids[path] = (root_id, abspath)
+            self.root_paths[root_id] = (path, abspath)
+        return root
+
+    def _root_path(self, root_id):
+        # (path, abspath) of a root
+        if root_id is None:
+            return None, None
+        root = self.root_paths.get(root_id)
+        if root is None:
+            root = self.root_paths[root_id] = tuple(self.connection.execute(
+                'select path, abspath from roots where id = ?', (root_id,)).fetchone())
+        return root
+
+    def _paths(self, row):
+        # (fullname, path, abspath) of a row ending with the PATH_COLUMNS
+        dir_id, name, root_id, fullname = row[-4:]
+        abspath = os.path.join(self._directory_path(dir_id), name)
+        path, path_abspath = self._root_path(root_id)
+        if fullname is None:
+            fullname = _fullname(path, path_abspath, abspath)
+        return fullname, path, abspath
+
+    def _normalized(self, name, size, path, abspath, realpath, mtime_ns, dev, ino, *rest):
+        # (dir_id, name, root_id, fullname, real_dir_id, real_name, size,
+        # mtime_ns, dev, ino) of a row of add_files. fullname is null when it
+        # can be derived from path and abspath, see _fullname
+        dir_abspath, basename = os.path.split(abspath)
+        root_id, root_abspath = self._root_id(path)
+        if realpath is None:
+            real_dir_id, real_name = NO_REALPATH, None
+        elif realpath == abspath:
+            real_dir_id, real_name = None, None
+        else:
+            real_dir, real_name = os.path.split(realpath)
+            real_dir_id = self._directory_id(real_dir)
+        return (
+            self._directory_id(dir_abspath), basename, root_id,
+            None if _fullname(path, root_abspath, abspath) == name else name,
+            real_dir_id, real_name, size, mtime_ns, dev, ino
         )
 
+    def _file_id(self, fullname):
+        # the id of the file named fullname, None if it isn't indexed
+        row = self.connection.execute('select id from files where fullname = ?', (fullname,)).fetchone()
+        if row is not None:
+            return row[0]
+        return self._file_id_by_abspath(os.path.abspath(fullname), 'and fullname is null')
+
+    def _file_id_by_abspath(self, abspath, condition=''):
+        dir_abspath, name = os.path.split(abspath)
+        dir_id = self._directory_id(dir_abspath, create=False)
+        if dir_id is None:
+            return None
+        row = self.connection.execute(
+            'select id from files where dir_id = ? and name = ? ' + condition, (dir_id, name)).fetchone()
+        return row[0] if row is not None else None
+
+    def _file_rows(self, rows):
+        # the (hash, size, fullname, path, abspath) rows of the finders
+        for row in rows:
+            yield _file_row(tuple(row[:2]) + self._paths(row))
+
+    def _size_rows(self, rows):
+        # the (size, fullname) rows of the finders
+        for row in rows:
+            yield _size_row((row[0], self._paths(row)[0]))
+
+    def _by_fullname(self, rows, build, columns):
+        # The rows, built by build, sorted by fullname within the groups of
+        # rows with the same first columns. The fullnames are only known
+        # once the rows are built
+        for key, grouped in groupby(rows, lambda row: tuple(row[:columns])):
+            for row in sorted(build(grouped), key=lambda row: row['fullname']):
+                yield row
+
     def delete_file(self, path_to_delete):
-        query = 'SELECT f.fullname, f.size, f.hash, f.path, f.abspath \
+        query = 'SELECT {paths} \
               FROM files AS f \
-              INNER JOIN files AS ff ON ff.hash = f.hash AND ff.size = f.size AND ff.realpath <> f.realpath \
-              WHERE ff.abspath = ?'
+              INNER JOIN files AS ff ON ff.hash = f.hash AND ff.size = f.size AND {ff_realpath} <> {f_realpath} \
+              WHERE ff.id = ?'.format(
+            paths=PATH_COLUMNS.format(f='f'), ff_realpath=REALPATH.format(f='ff'), f_realpath=REALPATH.format(f='f'))
 
+        file_id = self._file_id_by_abspath(path_to_delete)
         file_count = 0
-        for fullname, size, hash, path, abspath \
-        in self.connection.execute(query, (path_to_delete,)):
+        for row in self.connection.execute(query, (file_id,)).fetchall():
+            fullname, path, abspath = self._paths(row)
             # check real path to prevent counting symlinks pointing to not
             # valid locations
             if os.path.exists(abspath):
@@ -121,34 +757,198 @@ class repository():
         else:
             raise Exception("409 Can't delete a file without duplicates: {}".format(path_to_delete))
 
-        self.connection.execute('DELETE FROM files WHERE abspath = ?', (path_to_delete,))
+        self.connection.execute('DELETE FROM files WHERE id = ?', (file_id,))
 
     def add_file(self, name, size, path, abspath, realpath):
         logging.debug(
-            'INSERT INTO files(fullname, size, path, abspath, realpath) VALUES("{}",{},"{}","{}","{}")'.format(
-                name, size, path, abspath, realpath
+            'INSERT INTO files(fullname, size, path, abspath, realpath) VALUES("%s",%s,"%s","%s","%s")',
+            name, size, path, abspath, realpath
+        )
+        self.add_files([(name, size, path, abspath, realpath, None, None, None, None)])
+
+    def add_files(self, files, batch_size=BATCH_SIZE, scan_id=None):
+        # files yields (name, size, path, abspath, realpath, mtime_ns, dev, ino, dir_id) tuples,
+        # they are upserted and committed batch_size rows at a time. A file
+        # already in the index keeps its sample and hash if its size and
+        # mtime didn't change. A file is stored in the directory of its
+        # abspath, dir_id is the same directory
+        files = iter(files)
+        count = 0
+        while True:
+            batch = [self._normalized(*row) + (scan_id,) for row in islice(files, batch_size)]
+            if not batch:
+                return count
+            self.connection.executemany(
+                'INSERT INTO files(dir_id, name, root_id, fullname, real_dir_id, real_name, size, mtime_ns, dev, ino, scan_id) '
+                'VALUES(?,?,?,?,?,?,?,?,?,?,?) '
+                'ON CONFLICT(dir_id, name) DO UPDATE SET '
+                '  root_id = excluded.root_id, '
+                '  fullname = excluded.fullname, '
+                '  real_dir_id = excluded.real_dir_id, '
+                '  real_name = excluded.real_name, '
+                '  dev = excluded.dev, '
+                '  ino = excluded.ino, '
+                '  scan_id = excluded.scan_id, '
+                '  size = excluded.size, '
+                '  mtime_ns = excluded.mtime_ns, '
+                '  sample = CASE WHEN {unchanged} THEN sample END, '
+                '  hash = CASE WHEN {unchanged} THEN hash END, '
+                '  state = CASE WHEN {unchanged} THEN state ELSE {new:d} END'.format(
+                    unchanged='size IS excluded.size AND mtime_ns IS excluded.mtime_ns', new=STATE_NEW
+                ),
+                batch
+            )
+            self.connection.commit()
+            count += len(batch)
+            logging.debug('%s files inserted', count)
+
+    def _normalize_paths(self):
+        # Schema migration 9: the rows of files_paths and directories_paths,
+        # the tables with the path columns, are stored by directory and name.
+        # Relative paths are taken from the current directory, the fullnames
+        # that don't match are kept as they are
+        old_files = self.connection.execute(
+            'select fullname, size, path, abspath, realpath, mtime_ns, dev, ino, scan_id, sample, hash, state '
+            'from files_paths')
+        while True:
+            batch = [self._normalized(*row[:8]) + tuple(row[8:]) for row in old_files.fetchmany(BATCH_SIZE)]
+            if not batch:
+                break
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO files('
+                '  dir_id, name, root_id, fullname, real_dir_id, real_name, size, mtime_ns, dev, ino, '
+                '  scan_id, sample, hash, state'
+                ') VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                batch
+            )
+
+        for abspath, dev, ino, mtime_ns, is_link, scan_id in self.connection.execute(
+                'select abspath, dev, ino, mtime_ns, is_link, scan_id from directories_paths').fetchall():
+            self.connection.execute(
+                'update directories set dev = ?, ino = ?, mtime_ns = ?, is_link = ?, scan_id = ? where id = ?',
+                (dev, ino, mtime_ns, is_link, scan_id, self._directory_id(abspath))
             )
+
+    def start_scan(self, algorithm):
+        # Returns the id of a new scan. The hashes of the previous scans are
+        # discarded if they were computed with another algorithm
+        row = self.connection.execute('select algorithm from scans order by id desc limit 1').fetchone()
+        if row is not None and row[0] != algorithm:
+            logging.warning('The index was hashed with %s, hashing it again with %s', row[0], algorithm)
+            self.connection.execute(
+                'update files set hash = null, state = min(state, ?)', (STATE_SAMPLED,))
+
+        self.scan_id = self.connection.execute(
+            'INSERT INTO scans(algorithm, started) VALUES(?, CURRENT_TIMESTAMP)', (algorithm,)
+        ).lastrowid
+        return self.scan_id
+
+    def finish_scan(self, scan_id):
+        # every file found by scan_id is in the index, the directory listings
+        # it recorded can be reused
+        self.connection.execute('update scans set finished = CURRENT_TIMESTAMP where id = ?', (scan_id,))
+        self.connection.commit()
+
+    def delete_missing(self, path, scan_id):
+        # Removes the files under path that scan_id didn't find on disk, and
+        # then the directories it didn't find that are left without files or
+        # subdirectories
+        dir_id = self._directory_id(os.path.abspath(path), create=False)
+        if dir_id is None:
+            return 0
+        tree = (
+            'WITH RECURSIVE tree(id) AS ( '
+            '  SELECT ? '
+            '  UNION ALL '
+            '  SELECT d.id FROM directories d INNER JOIN tree t ON d.parent_id = t.id '
+            ') '
         )
+        deleted = self.connection.execute(
+            tree +
+            'DELETE FROM files '
+            'WHERE dir_id IN tree '
+            'AND (scan_id IS NULL OR scan_id <> ?)',
+            (dir_id, scan_id)
+        ).rowcount
+
+        while self.connection.execute(
+                tree +
+                'DELETE FROM directories '
+                'WHERE id IN tree AND id <> ? '
+                'AND (scan_id IS NULL OR scan_id <> ?) '
+                'AND NOT EXISTS (SELECT 1 FROM files f WHERE f.dir_id = directories.id) '
+                'AND NOT EXISTS (SELECT 1 FROM files f WHERE f.real_dir_id = directories.id) '
+                'AND NOT EXISTS (SELECT 1 FROM directories d WHERE d.parent_id = directories.id)',
+                (dir_id, dir_id, scan_id)
+        ).rowcount:
+            self.directory_ids.clear()
+            self.directory_paths.clear()
+        # and the ones still referenced aren't listed again
+        self.connection.execute(
+            tree +
+            'UPDATE directories SET dev = NULL, ino = NULL, mtime_ns = NULL, is_link = NULL, scan_id = NULL '
+            'WHERE id IN tree AND id <> ? AND scan_id <> ?',
+            (dir_id, dir_id, scan_id)
+        )
+
+        logging.info('%s files missing from %s removed from the index', deleted, path)
+        return deleted
+
+    def find_directory(self, abspath):
+        # (id, dev, ino, mtime_ns) of a directory whose listing can be
+        # reused: recorded with its mtime by a finished scan
+        dir_id = self._directory_id(abspath, create=False)
+        if dir_id is None:
+            return None
+        return self.connection.execute(
+            'select d.id, d.dev, d.ino, d.mtime_ns '
+            'from directories d '
+            'inner join scans s on s.id = d.scan_id '
+            'where d.id = ? and d.mtime_ns is not null and s.finished is not null',
+            (dir_id,)
+        ).fetchone()
+
+    def add_directory(self, abspath, parent_id, dev, ino, mtime_ns, is_link):
+        # records a directory found by the scan in progress, returns its id.
+        # parent_id is the id of the directory of abspath
+        dir_id = self._directory_id(abspath)
         self.connection.execute(
-            'INSERT INTO files(fullname, size, path, abspath, realpath) VALUES(?,?,?,?,?)',
-            (name, size, path, abspath, realpath)
+            'update directories set dev = ?, ino = ?, mtime_ns = ?, is_link = ?, scan_id = ? where id = ?',
+            (dev, ino, mtime_ns, is_link, self.scan_id, dir_id)
         )
+        return dir_id
+
+    def findBy_directory(self, dir_id):
+        # names of the files in a directory
+        for name, in self.connection.execute('select name from files where dir_id = ?', (dir_id,)).fetchall():
+            yield name
+
+    def findBy_parent_directory(self, dir_id):
+        # (name, is_link) of the subdirectories of a directory recorded by a
+        # scan, not the ones only added as the parent of a path
+        for name, is_link in self.connection.execute(
+                'select name, is_link from directories where parent_id = ? and scan_id is not null',
+                (dir_id,)).fetchall():
+            yield name, bool(is_link)
 
     def find_clusters(self, page=None, page_size=None):
         return self.connection.execute(
             'select hash, size, count(*) '
             'from files f '
-            'group by hash, size, realpath'
+            'group by hash, size, {}'.format(REALPATH.format(f='f'))
         )
 
     def findBy_hash_size(self, hash, size):
-        return self.connection.execute(
-            'select fullname, size, hash, path, abspath '
-            'from files '
+        rows = self.connection.execute(
+            'select hash, size, {} '
+            'from files f '
             'where hash = ? '
-            'and size = ?',
+            'and size = ?'.format(PATH_COLUMNS.format(f='f')),
             (hash, size)
         )
+        for row in rows:
+            fullname, path, abspath = self._paths(row)
+            yield _hash_size_row((fullname, row[1], row[0], path, abspath))
 
     # def iterateOn_duplicate_hash(self):
     #     for duplicate in self.connection.execute('''
@@ -166,36 +966,66 @@ class repository():
     #   '''):
     #         return duplicate
 
-    def findBy_duplicate_hash(self):
-        # TODO: Manage links
+    def _identity(self, skip_hardlinks):
+        return (FILE_IDENTITY if skip_hardlinks else REALPATH).format(f='files')
 
-        return self.connection.execute('''
-        select hash, size, fullname, path, abspath
+    def findBy_cluster(self, hash, size, skip_hardlinks=False):
+        # the rows of findBy_duplicate_hash for a single (size, hash) group
+        rows = self.connection.execute('''
+        select f.hash, f.size, {paths}
         from files f
-        where exists (
-          select 1
-          from files f2
-          where f.size = f2.size 
-          and f.hash = f2.hash
-          and f.realpath <> f2.realpath
-        )
-        order by hash, size, fullname
-      ''')
+        where f.size = :size and f.hash = :hash and {has_realpath}
+        and (
+          select count(distinct {identity})
+          from files
+          where size = :size and hash = :hash
+        ) > 1
+      '''.format(
+            paths=PATH_COLUMNS.format(f='f'), has_realpath=HAS_REALPATH.format(f='f'),
+            identity=self._identity(skip_hardlinks)
+        ), {'size': size, 'hash': hash})
+        return sorted(self._file_rows(rows), key=lambda row: row['fullname'])
 
-    def findBy_unique_hash(self):
-        return self.connection.execute('''
-        select hash, size, fullname, path, abspath
+    def findBy_duplicate_hash(self, skip_hardlinks=False):
+        # Every (size, hash) group is evaluated once, instead of once per
+        # file. A null realpath never makes a file a duplicate.
+        # skip_hardlinks=True doesn't count hardlinks to the same inode as
+        # duplicates, they are already deduplicated
+        rows = self.connection.execute('''
+        select f.hash, f.size, {paths}
         from files f
-        where f.hash is null or
-              f.size is null or
-              not exists (
-                  select 1
-                  from files f2
-                  where f.size = f2.size and f.hash = f2.hash
-                  and f.realpath <> f2.realpath
-              )
+        inner join (
+          select size, hash
+          from files
+          group by size, hash
+          having count(distinct {identity}) > 1
+        ) d on d.size = f.size and d.hash = f.hash
+        where {has_realpath}
         order by f.hash, f.size
-      ''')
+      '''.format(
+            paths=PATH_COLUMNS.format(f='f'), has_realpath=HAS_REALPATH.format(f='f'),
+            identity=self._identity(skip_hardlinks)
+        ))
+        return self._by_fullname(rows, self._file_rows, 2)
+
+    def findBy_unique_hash(self, skip_hardlinks=False):
+        # the complement of findBy_duplicate_hash: a null size or hash never
+        # joins a duplicate group
+        return self._file_rows(self.connection.execute('''
+        select f.hash, f.size, {paths}
+        from files f
+        left join (
+          select size, hash
+          from files
+          group by size, hash
+          having count(distinct {identity}) > 1
+        ) d on d.size = f.size and d.hash = f.hash
+        where d.size is null or not {has_realpath}
+        order by f.hash, f.size
+      '''.format(
+            paths=PATH_COLUMNS.format(f='f'), has_realpath=HAS_REALPATH.format(f='f'),
+            identity=self._identity(skip_hardlinks)
+        )))
 
     # def iterateOn_unique_hash(self):
     #     for unique in self.connection.execute('''
@@ -215,48 +1045,1061 @@ class repository():
     #   '''):
     #         return unique
 
-    def findBy_duplicate_size(self):
+    def findBy_duplicate_size(self, before_state=None, one_per_inode=False):
+        # before_state only returns the files that haven't reached that state,
+        # the groups are still made of every file. one_per_inode only returns
+        # the first name of the files with hardlinks. The groups that may
+        # reclaim the most bytes, (files - 1) * size, come first
+        rows = self.connection.execute(
+            'select f.size, {paths} '
+            'from files f '
+            'inner join ( '
+            '  select size, (count(distinct {realpath}) - 1) * size as savings '
+            '  from files '
+            '  group by size '
+            '  having count(distinct {realpath}) > 1 '
+            ') d on d.size = f.size '
+            'where {has_realpath} '
+            'and (:state is null or f.state < :state) '
+            'and {first_name} '
+            'order by d.savings desc, f.size'.format(
+                paths=PATH_COLUMNS.format(f='f'), realpath=REALPATH.format(f='files'),
+                has_realpath=HAS_REALPATH.format(f='f'), first_name=self._first_name(one_per_inode)
+            ),
+            {'state': before_state}
+        )
+        return self._by_fullname(rows, self._size_rows, 1)
+
+    def findBy_duplicate_sample(self, before_state=None, one_per_inode=False):
+        # A null sample never discards a file: it is either too small to be
+        # sampled or it couldn't be read, and the full checksum decides.
+        # Sorted like findBy_duplicate_size, by the savings of the
+        # (size, sample) group when the file has a sample
+        rows = self.connection.execute(
+            'select f.size, f.sample, {paths} '
+            'from files f '
+            'inner join ( '
+            '  select size, (count(distinct {realpath}) - 1) * size as savings '
+            '  from files '
+            '  group by size '
+            '  having count(distinct {realpath}) > 1 '
+            ') d on d.size = f.size '
+            'left join ( '
+            '  select size, sample, (count(distinct {realpath}) - 1) * size as savings '
+            '  from files '
+            '  group by size, sample '
+            '  having count(distinct {realpath}) > 1 '
+            ') ds on ds.size = f.size and ds.sample = f.sample '
+            'where {has_realpath} '
+            'and (f.sample is null or ds.size is not null) '
+            'and (:state is null or f.state < :state) '
+            'and {first_name} '
+            'order by coalesce(ds.savings, d.savings) desc, f.size, f.sample'.format(
+                paths=PATH_COLUMNS.format(f='f'), realpath=REALPATH.format(f='files'),
+                has_realpath=HAS_REALPATH.format(f='f'), first_name=self._first_name(one_per_inode)
+            ),
+            {'state': before_state}
+        )
+        return self._by_fullname(rows, self._size_rows, 2)
+
+    def _first_name(self, one_per_inode):
+        if not one_per_inode:
+            return '1'
+        return '(f.ino is null or f.id = (select min(s.id) from files s where {}))'.format(
+            SAME_INODE.format(f='f'))
+
+    def find_state(self, name):
+        # (state, sample) of a file, or None if it isn't indexed
         return self.connection.execute(
-            'select size, fullname '
+            'select state, sample from files where id = ?', (self._file_id(name),)).fetchone()
+
+    def update_sample(self, name, sample):
+        self._update_hardlinks(name, 'sample = ?, state = ?', (sample, STATE_SAMPLED))
+
+    def update_file(self, name, hash, state=STATE_HASHED):
+        logging.info('update files set hash = "%s" where fullname="%s"', hash, name)
+        self._update_hardlinks(name, 'hash = ?, state = ?', (hash, state))
+
+    def findBy_small_size_group(self, max_files, one_per_inode=False):
+        # The files of the size groups of up to max_files files with any file
+        # that wasn't compared yet. Sorted like findBy_duplicate_size
+        rows = self.connection.execute(
+            'select f.size, {paths} '
             'from files f '
-            'where exists ( '
-            '  select 1 '
-            '  from files f2 '
-            '  where f.size = f2.size '
-            '  and f.realpath <> f2.realpath '
-            ') '
-            'order by f.hash, f.size'
+            'inner join ( '
+            '  select size, (count(distinct {realpath}) - 1) * size as savings '
+            '  from files '
+            '  group by size '
+            '  having count(distinct {realpath}) between 2 and :max_files '
+            '  and sum(state <> :compared) > 0 '
+            ') d on d.size = f.size '
+            'where {has_realpath} '
+            'and {first_name} '
+            'order by d.savings desc, f.size'.format(
+                paths=PATH_COLUMNS.format(f='f'), realpath=REALPATH.format(f='files'),
+                has_realpath=HAS_REALPATH.format(f='f'), first_name=self._first_name(one_per_inode)
+            ),
+            {'max_files': max_files, 'compared': STATE_COMPARED}
+        )
+        return self._by_fullname(rows, self._size_rows, 1)
+
+    def reset_compared(self, max_files):
+        # the files compared in a size group that now has more than max_files
+        # files have to be hashed. Returns how many were reset
+        return self.connection.execute(
+            'update files set hash = null, state = :new '
+            'where state = :compared and size in ( '
+            '  select size '
+            '  from files '
+            '  group by size '
+            '  having count(distinct {}) > :max_files '
+            ')'.format(REALPATH.format(f='files')),
+            {'new': STATE_NEW, 'compared': STATE_COMPARED, 'max_files': max_files}
+        ).rowcount
+
+    def _update_hardlinks(self, name, assignments, values):
+        # the hardlinks to the same inode as name get the same values
+        file_id = self._file_id(name)
+        self.connection.execute(
+            'update files set {} where id in ( '
+            '  select s.id from files f '
+            '  inner join files s on {} '
+            '  where f.id = ? '
+            ') or id = ?'.format(assignments, SAME_INODE.format(f='f')),
+            values + (file_id, file_id)
+        )
+
+    def copy_hardlink_hashes(self):
+        # Files with a hardlink hashed by a previous scan get its sample and
+        # hash. Returns how many files were updated
+        hashed = 'select {{column}} from files s where {} and s.state = :hashed'.format(SAME_INODE.format(f='files'))
+        return self.connection.execute(
+            'update files set '
+            '  sample = ({sample}), '
+            '  hash = ({hash}), '
+            '  state = :hashed '
+            'where state < :hashed and ino is not null '
+            'and exists ({exists})'.format(
+                sample=hashed.format(column='s.sample'),
+                hash=hashed.format(column='s.hash'),
+                exists=hashed.format(column='1')
+            ),
+            {'hashed': STATE_HASHED}
+        ).rowcount
+
+
+class _file_record():
+    # a row of the files table of memory_repository
+
+    __slots__ = (
+        'fullname', 'size', 'path', 'abspath', 'realpath', 'mtime_ns', 'dev', 'ino', 'dir_id', 'scan_id',
+        'sample', 'hash', 'state'
+    )
+
+    def __init__(self, fullname, size, path, abspath, realpath, mtime_ns, dev, ino, dir_id, scan_id):
+        self.fullname = fullname
+        self.size = size
+        self.path = path
+        self.abspath = abspath
+        self.realpath = realpath
+        self.mtime_ns = mtime_ns
+        self.dev = dev
+        self.ino = ino
+        self.dir_id = dir_id
+        self.scan_id = scan_id
+        self.sample = None
+        self.hash = None
+        self.state = STATE_NEW
+
+    @property
+    def inode(self):
+        # the key shared by the hardlinks to the same inode, see SAME_INODE
+        if None in (self.dev, self.ino, self.size, self.mtime_ns):
+            return None
+        return self.dev, self.ino, self.size, self.mtime_ns
+
+    def identity(self, skip_hardlinks):
+        # see FILE_IDENTITY
+        if skip_hardlinks and self.dev is not None and self.ino is not None:
+            return self.dev, self.ino
+        return self.realpath
+
+    def row(self):
+        return _file_row((self.hash, self.size, self.fullname, self.path, self.abspath))
+
+
+def _distinct(records, skip_hardlinks=False):
+    # count(distinct realpath) of the records, or of their identity
+    return len({record.identity(skip_hardlinks) for record in records} - {None})
+
+
+def _sql_order(value):
+    # sorts like SQLite: null, then numbers, then text, then blobs
+    if value is None:
+        return 0, 0
+    if isinstance(value, bytes):
+        return 3, value
+    if isinstance(value, str):
+        return 2, value
+    return 1, value
+
+
+class memory_repository():
+    # The repository interface without SQLite, for indexes that don't outlive
+    # the process. The files are kept in dicts by fullname, by size and by
+    # (size, hash), and the finders compute the same rows, in the same order,
+    # in Python. Rows can be read by position or by column name
+
+    def __init__(self):
+        self.files = {}
+        self.by_size = {}
+        self.by_hash = {}
+        # hardlinks, by _file_record.inode, and the files of every directory
+        self.by_inode = {}
+        self.by_dir = {}
+        # abspath: [id, parent_id, dev, ino, mtime_ns, is_link, scan_id]
+        self.directories = {}
+        self.subdirectories = {}
+        self.last_directory_id = 0
+        # [algorithm, finished] of every scan, by id - 1
+        self.scans = []
+        self.scan_id = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        pass
+
+    def commit(self):
+        pass
+
+    def create_schema(self):
+        pass
+
+    def _index(self, record):
+        if record.size is not None:
+            self.by_size.setdefault(record.size, {})[record.fullname] = record
+            if record.hash is not None:
+                self.by_hash.setdefault((record.size, record.hash), {})[record.fullname] = record
+        if record.inode is not None:
+            self.by_inode.setdefault(record.inode, {})[record.fullname] = record
+        if record.dir_id is not None:
+            self.by_dir.setdefault(record.dir_id, {})[record.fullname] = record
+
+    def _unindex(self, record):
+        for index, key in (
+                (self.by_size, record.size),
+                (self.by_hash, (record.size, record.hash)),
+                (self.by_inode, record.inode),
+                (self.by_dir, record.dir_id)):
+            group = index.get(key)
+            if group is not None:
+                group.pop(record.fullname, None)
+                if not group:
+                    del index[key]
+
+    def _update(self, records, **values):
+        for record in list(records):
+            self._unindex(record)
+            for name, value in values.items():
+                setattr(record, name, value)
+            self._index(record)
+
+    def _remove(self, records):
+        for record in list(records):
+            self._unindex(record)
+            del self.files[record.fullname]
+
+    def delete_file(self, path_to_delete):
+        file_count = 0
+        for deleted in [record for record in self.files.values() if record.abspath == path_to_delete]:
+            for record in self.by_hash.get((deleted.size, deleted.hash), {}).values():
+                if None in (record.realpath, deleted.realpath) or record.realpath == deleted.realpath:
+                    continue
+                # check real path to prevent counting symlinks pointing to not
+                # valid locations
+                if os.path.exists(record.abspath):
+                    file_count += 1
+                else:
+                    raise AssertionError('500 Database is inconsistent %s not found in the filesystem {}'.format(record.abspath))
+
+        if file_count > 0:
+            logging.debug("before removing {}".format(path_to_delete))
+            os.remove(path_to_delete)
+            logging.debug("after removing {}".format(path_to_delete))
+        else:
+            raise Exception("409 Can't delete a file without duplicates: {}".format(path_to_delete))
+
+        self._remove(record for record in self.files.values() if record.abspath == path_to_delete)
+
+    def add_file(self, name, size, path, abspath, realpath):
+        self.add_files([(name, size, path, abspath, realpath, None, None, None, None)])
+
+    def add_files(self, files, batch_size=BATCH_SIZE, scan_id=None):
+        # same as repository.add_files, there is nothing to batch
+        count = 0
+        for name, size, path, abspath, realpath, mtime_ns, dev, ino, dir_id in files:
+            record = self.files.get(name)
+            if record is None:
+                record = self.files[name] = _file_record(
+                    name, size, path, abspath, realpath, mtime_ns, dev, ino, dir_id, scan_id)
+            else:
+                self._unindex(record)
+                if record.size != size or record.mtime_ns != mtime_ns:
+                    record.sample = record.hash = None
+                    record.state = STATE_NEW
+                record.size, record.path, record.abspath, record.realpath = size, path, abspath, realpath
+                record.mtime_ns, record.dev, record.ino, record.dir_id = mtime_ns, dev, ino, dir_id
+                record.scan_id = scan_id
+            self._index(record)
+            count += 1
+        logging.debug('%s files inserted', count)
+        return count
+
+    def start_scan(self, algorithm):
+        if self.scans and self.scans[-1][0] != algorithm:
+            logging.warning('The index was hashed with %s, hashing it again with %s', self.scans[-1][0], algorithm)
+            for record in list(self.files.values()):
+                self._update((record,), hash=None, state=min(record.state, STATE_SAMPLED))
+
+        self.scans.append([algorithm, False])
+        self.scan_id = len(self.scans)
+        return self.scan_id
+
+    def finish_scan(self, scan_id):
+        self.scans[scan_id - 1][1] = True
+
+    def delete_missing(self, path, scan_id):
+        abspath = os.path.join(os.path.abspath(path), '')
+
+        def missing(found_abspath, found_scan_id):
+            return found_abspath.startswith(abspath) and found_scan_id != scan_id
+
+        deleted = [record for record in self.files.values() if missing(record.abspath, record.scan_id)]
+        self._remove(deleted)
+        for dir_abspath, directory in list(self.directories.items()):
+            if missing(dir_abspath, directory[6]):
+                del self.directories[dir_abspath]
+                self.subdirectories.get(directory[1], {}).pop(dir_abspath, None)
+        logging.info('%s files missing from %s removed from the index', len(deleted), path)
+        return len(deleted)
+
+    def find_directory(self, abspath):
+        directory = self.directories.get(abspath)
+        if directory is None or directory[4] is None or directory[6] is None or not self.scans[directory[6] - 1][1]:
+            return None
+        return _directory_row((directory[0], directory[2], directory[3], directory[4]))
+
+    def add_directory(self, abspath, parent_id, dev, ino, mtime_ns, is_link):
+        directory = self.directories.get(abspath)
+        if directory is None:
+            self.last_directory_id += 1
+            directory = self.directories[abspath] = [self.last_directory_id, None]
+        self.subdirectories.get(directory[1], {}).pop(abspath, None)
+        directory[1:] = [parent_id, dev, ino, mtime_ns, is_link, self.scan_id]
+        self.subdirectories.setdefault(parent_id, {})[abspath] = directory
+        return directory[0]
+
+    def findBy_directory(self, dir_id):
+        return [os.path.basename(record.abspath) for record in self.by_dir.get(dir_id, {}).values()]
+
+    def findBy_parent_directory(self, dir_id):
+        return [
+            (os.path.basename(abspath), bool(directory[5]))
+            for abspath, directory in self.subdirectories.get(dir_id, {}).items()
+        ]
+
+    def find_clusters(self, page=None, page_size=None):
+        counts = {}
+        for record in self.files.values():
+            key = (record.hash, record.size, record.realpath)
+            counts[key] = counts.get(key, 0) + 1
+        return [
+            _cluster_row((hash, size, count))
+            for (hash, size, realpath), count in sorted(
+                counts.items(), key=lambda item: tuple(_sql_order(value) for value in item[0]))
+        ]
+
+    def findBy_hash_size(self, hash, size):
+        return [
+            _hash_size_row((record.fullname, record.size, record.hash, record.path, record.abspath))
+            for record in self.by_hash.get((size, hash), {}).values()
+        ]
+
+    def findBy_cluster(self, hash, size, skip_hardlinks=False):
+        group = self.by_hash.get((size, hash), {}).values()
+        if _distinct(group, skip_hardlinks) < 2:
+            return []
+        return [
+            record.row()
+            for record in sorted(group, key=attrgetter('fullname'))
+            if record.realpath is not None
+        ]
+
+    def _duplicate_hashes(self, skip_hardlinks):
+        return {key for key, group in self.by_hash.items() if _distinct(group.values(), skip_hardlinks) > 1}
+
+    def findBy_duplicate_hash(self, skip_hardlinks=False):
+        # sorted a (size, hash) group at a time
+        return [
+            record.row()
+            for size, hash in sorted(self._duplicate_hashes(skip_hardlinks), key=lambda key: (_sql_order(key[1]), key[0]))
+            for record in sorted(self.by_hash[size, hash].values(), key=attrgetter('fullname'))
+            if record.realpath is not None
+        ]
+
+    def findBy_unique_hash(self, skip_hardlinks=False):
+        duplicates = self._duplicate_hashes(skip_hardlinks)
+        records = [
+            record
+            for record in self.files.values()
+            if (record.size, record.hash) not in duplicates or record.realpath is None
+        ]
+        records.sort(key=lambda record: (_sql_order(record.hash), _sql_order(record.size), record.fullname))
+        return [record.row() for record in records]
+
+    def _size_groups(self, min_files=2, max_files=None):
+        # (savings, size, files) of the size groups with min_files to
+        # max_files distinct files
+        for size, group in self.by_size.items():
+            files = _distinct(group.values())
+            if files >= min_files and (max_files is None or files <= max_files):
+                yield (files - 1) * size, size, group.values()
+
+    def _first_name(self, record, one_per_inode):
+        if not one_per_inode or record.ino is None:
+            return True
+        return record.inode is not None and record.fullname == min(self.by_inode[record.inode])
+
+    def _candidates(self, records, before_state, one_per_inode):
+        return (
+            record for record in records
+            if record.realpath is not None
+            and (before_state is None or record.state < before_state)
+            and self._first_name(record, one_per_inode)
+        )
+
+    def _size_rows(self, groups, before_state, one_per_inode):
+        # the rows of the files of groups, by savings, size and fullname. The
+        # files of a group share their savings and size
+        rows = []
+        for savings, size, group in sorted(groups, key=lambda found: (-found[0], found[1])):
+            rows.extend(
+                _size_row((size, fullname))
+                for fullname in sorted(record.fullname for record in self._candidates(group, before_state, one_per_inode))
+            )
+        return rows
+
+    def findBy_duplicate_size(self, before_state=None, one_per_inode=False):
+        return self._size_rows(self._size_groups(), before_state, one_per_inode)
+
+    def findBy_duplicate_sample(self, before_state=None, one_per_inode=False):
+        found = []
+        for savings, size, group in self._size_groups():
+            samples = {}
+            for record in group:
+                if record.sample is not None:
+                    samples.setdefault(record.sample, []).append(record)
+            for record in self._candidates(group, before_state, one_per_inode):
+                if record.sample is None:
+                    found.append((savings, record))
+                    continue
+                files = _distinct(samples[record.sample])
+                if files > 1:
+                    found.append(((files - 1) * record.size, record))
+        found.sort(key=lambda item: (-item[0], item[1].size, _sql_order(item[1].sample), item[1].fullname))
+        return [_size_row((record.size, record.fullname)) for savings, record in found]
+
+    def find_state(self, name):
+        record = self.files.get(name)
+        if record is None:
+            return None
+        return _state_row((record.state, record.sample))
+
+    def update_sample(self, name, sample):
+        self._update(self._hardlinks(name), sample=sample, state=STATE_SAMPLED)
+
+    def update_file(self, name, hash, state=STATE_HASHED):
+        logging.info('update files set hash = "%s" where fullname="%s"', hash, name)
+        self._update(self._hardlinks(name), hash=hash, state=state)
+
+    def findBy_small_size_group(self, max_files, one_per_inode=False):
+        return self._size_rows(
+            (
+                (savings, size, group)
+                for savings, size, group in self._size_groups(2, max_files)
+                if any(record.state != STATE_COMPARED for record in group)
+            ),
+            None,
+            one_per_inode
         )
 
-    def update_file(self, name, hash):
-        logging.info(
-            'update files set hash = "{}" where fullname="{}"'.format(hash, name))
+    def reset_compared(self, max_files):
+        compared = [
+            record
+            for savings, size, group in self._size_groups(max_files + 1)
+            for record in group
+            if record.state == STATE_COMPARED
+        ]
+        self._update(compared, hash=None, state=STATE_NEW)
+        return len(compared)
+
+    def _hardlinks(self, name):
+        # name and the hardlinks to the same inode
+        record = self.files.get(name)
+        if record is None:
+            return []
+        if record.inode is None:
+            return [record]
+        return list(self.by_inode[record.inode].values())
+
+    def copy_hardlink_hashes(self):
+        count = 0
+        for group in list(self.by_inode.values()):
+            hashed = next((record for record in group.values() if record.state == STATE_HASHED), None)
+            if hashed is not None:
+                pending = [record for record in group.values() if record.state < STATE_HASHED]
+                self._update(pending, sample=hashed.sample, hash=hashed.hash, state=STATE_HASHED)
+                count += len(pending)
+        return count
+
+
+class checksum_cache():
+    # Checksums kept across runs, keyed by (st_dev, st_ino, size, mtime_ns):
+    # a file with the same inode, size and modification time is assumed to
+    # have the same contents. Checksums from different algorithms are kept
+    # apart
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.create_schema()
+        return self
+
+    def __exit__(self, type, value, tb):
+        # the cached checksums are valid even if the scan failed
+        self.connection.commit()
+        self.connection = None
+
+    def create_schema(self):
         self.connection.execute(
-            'update files set hash = ? where fullname=?', (hash, name))
+            'CREATE TABLE IF NOT EXISTS checksums('
+            '  algorithm TEXT, '
+            '  dev INT, '
+            '  ino INT, '
+            '  size INT, '
+            '  mtime_ns INT, '
+            '  hash BLOB, '
+            '  PRIMARY KEY (algorithm, dev, ino, size, mtime_ns)'
+            ')'
+        )
+
+    def find(self, algorithm, key):
+        row = self.connection.execute(
+            'select hash '
+            'from checksums '
+            'where algorithm = ? and dev = ? and ino = ? and size = ? and mtime_ns = ?',
+            (algorithm,) + key
+        ).fetchone()
+        if row is None:
+            return None
+        # cached as a hex digest by an older version
+        return bytes.fromhex(row[0]) if isinstance(row[0], str) else row[0]
+
+    def add(self, algorithm, key, hash):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO checksums(algorithm, dev, ino, size, mtime_ns, hash) VALUES(?,?,?,?,?,?)',
+            (algorithm,) + key + (hash,)
+        )
+
+
+class cluster(namedtuple('cluster', 'hash size files')):
+    # A confirmed group of duplicates, yielded by DupScanner.iter_clusters.
+    # files are the rows of findBy_duplicate_hash, sorted by fullname
+
+    __slots__ = ()
+
+    @property
+    def paths(self):
+        return tuple(row['fullname'] for row in self.files)
+
+    @classmethod
+    def of(cls, rows):
+        # the cluster of the rows of a (hash, size) group, None if there
+        # aren't any
+        rows = tuple(rows)
+        if not rows:
+            return None
+        return cls(rows[0]['hash'], rows[0]['size'], rows)
+
+
+class pipeline_stats():
+    # Files, bytes and busy seconds of every stage of
+    # DupScanner.insert_files_pipelined, updated by several threads
+
+    STAGES = ('walk', 'insert', 'sample', 'hash')
+
+    def __init__(self):
+        self.files = dict.fromkeys(self.STAGES, 0)
+        self.bytes = dict.fromkeys(self.STAGES, 0)
+        self.seconds = dict.fromkeys(self.STAGES, 0.0)
+        self.lock = threading.Lock()
+
+    def add(self, stage, files, size, seconds):
+        with self.lock:
+            self.files[stage] += files
+            self.bytes[stage] += size
+            self.seconds[stage] += seconds
+
+    def log(self, path):
+        for stage in self.STAGES:
+            seconds = self.seconds[stage] or float('inf')
+            logging.info(
+                '%s %s: %s files, %s bytes in %.3fs busy (%.0f files/s, %.1f MiB/s)',
+                path, stage, self.files[stage], self.bytes[stage], self.seconds[stage],
+                self.files[stage] / seconds, self.bytes[stage] / seconds / (1024 * 1024)
+            )
+
+
+class _hashing_pipeline():
+    # Samples and hashes the files inserted by
+    # DupScanner.insert_files_pipelined. A file is a candidate once a second
+    # file with its size is inserted, or once the size group is too big to
+    # be compared byte by byte, and it is hashed once a second file with its
+    # size and sample is found; a file too small to be sampled is hashed
+    # right away. Only the first name of an inode is read, and the files
+    # already sampled or hashed by a previous scan aren't read again.
+    # The jobs wait in queued until they fit in the inflight limits of
+    # the scanner, the results are written by the thread reading results
+
+    def __init__(self, scanner, executor, stats):
+        self.scanner = scanner
+        self.executor = executor
+        self.stats = stats
+        # candidates waiting for more files with their size or (size, sample),
+        # None once there are enough of them
+        self.groups = {}
+        # files in a size group before it is hashed, smaller groups are left
+        # to DupScanner._compare_groups
+        self.group_size = max(2, scanner.compare_max_files + 1)
+        # (dev, ino) of the files already handed to the workers
+        self.started = set()
+        self.queued = deque()
+        self.inflight = deque()
+        self.inflight_bytes = 0
+
+    def add(self, rows):
+        # rows were inserted by repository.add_files, their jobs are
+        # started by results
+        for name, size, path, abspath, realpath, mtime_ns, dev, ino, dir_id in rows:
+            if size is None or realpath is None:
+                continue
+            for candidate in self._join(size, (size, name, dev, ino), self.group_size):
+                self._start(candidate)
+
+    def _join(self, key, candidate, group_size=2):
+        # the candidates that can start once candidate joins its group
+        waiting = self.groups.setdefault(key, [])
+        if waiting is None:
+            return [candidate]
+        waiting.append(candidate)
+        if len(waiting) < group_size:
+            return []
+        self.groups[key] = None
+        return waiting
+
+    def _start(self, candidate):
+        size, name, dev, ino = candidate
+        if ino is not None:
+            if (dev, ino) in self.started:
+                return
+            self.started.add((dev, ino))
+
+        state, sample = self.scanner.repository.find_state(name)
+        if state >= STATE_HASHED:
+            return
+        if self.scanner.sample_function is None or size <= 2 * self.scanner.sample_size:
+            self._hash(candidate)
+        elif state >= STATE_SAMPLED:
+            self._sampled(candidate, sample)
+        else:
+            self.queued.append(('sample', self.scanner._sample, candidate, self._sample_done))
+
+    def _sample_done(self, candidate, sample):
+        self.scanner.repository.update_sample(candidate[1], sample=sample)
+        self._sampled(candidate, sample)
+
+    def _sampled(self, candidate, sample):
+        # a null sample never discards a file
+        if sample is None:
+            self._hash(candidate)
+            return
+        for sampled in self._join((candidate[0], sample), candidate):
+            self._hash(sampled)
+
+    def _hash(self, candidate):
+        scanner = self.scanner
+        key = _cache_key(candidate[1]) if scanner.cache is not None else None
+        hash_value = scanner.cache.find(scanner.algorithm, key) if key is not None else None
+        if hash_value is not None:
+            scanner._update_file(candidate[0], candidate[1], hash_value)
+        else:
+            self.queued.append(('hash', scanner.hash_function, candidate + (key,), self._hashed))
+
+    def _hashed(self, candidate, hash_value):
+        key = candidate[4]
+        if key is not None and hash_value is not None:
+            self.scanner.cache.add(self.scanner.algorithm, key, hash_value)
+        self.scanner._update_file(candidate[0], candidate[1], hash_value)
+
+    def _run(self, stage, function, name, size):
+        start = perf_counter()
+        result = function(name)
+        self.stats.add(stage, 1, size, perf_counter() - start)
+        return result
+
+    def results(self, wait):
+        # Submits the queued jobs while they fit in the inflight limits,
+        # waiting for the oldest one otherwise, and yields after every result
+        # is written. wait=False returns once the jobs are submitted, and
+        # wait=True once every job is done. The callbacks only queue new
+        # jobs, so this doesn't recurse
+        scanner = self.scanner
+        while self.queued or (wait and self.inflight):
+            if self.queued and scanner._past_deadline():
+                logging.warning('Deadline reached, the files left will be hashed by the next scan')
+                self.queued.clear()
+                continue
+            if self.queued:
+                stage, function, candidate, done = self.queued[0]
+                size = candidate[0] or 0
+                if not self.inflight or (self.inflight_bytes + size <= scanner.max_inflight_bytes and
+                                         len(self.inflight) < 4 * scanner.workers):
+                    self.queued.popleft()
+                    future = self.executor.submit(self._run, stage, function, candidate[1], size)
+                    self.inflight.append((candidate, future, done))
+                    self.inflight_bytes += size
+                    continue
+            self._finish_oldest()
+            yield
+
+        while self.inflight and self.inflight[0][1].done():
+            self._finish_oldest()
+            yield
+
+    def _finish_oldest(self):
+        candidate, future, done = self.inflight.popleft()
+        self.inflight_bytes -= candidate[0] or 0
+        done(candidate, future.result())
 
 
 class DupScanner():
-    def __init__(self, repository, get_files=_get_files, hash_function=_md5_checksum):
+    def __init__(self, repository, get_files=_scandir_files, hash_function=_md5_checksum, cache=None,
+                 sample_function=_sample_checksum, sample_size=SAMPLE_SIZE,
+                 workers=1, max_inflight_bytes=MAX_INFLIGHT_BYTES, reader=None, cache_policy=None,
+                 pipeline=False, deadline=None, compare_max_files=0):
         self.repository = repository
         self.get_files = get_files
+        # reader and cache_policy select how a checksums.checksum reads the
+        # files, e.g. checksums.mmap_reader() and checksums.fadvise_policy()
+        if reader is not None:
+            hash_function = hash_function.using(reader=reader)
+        if cache_policy is not None:
+            hash_function = hash_function.using(cache_policy=cache_policy)
         self.hash_function = hash_function
+        self.cache_policy = cache_policy
+        # names the cached checksums of hash_function
+        self.algorithm = getattr(hash_function, 'algorithm', None) or hash_function.__name__
+        self.cache = cache
+        # sample_function=None hashes every file with a duplicate size
+        self.sample_function = sample_function
+        self.sample_size = sample_size
+        # workers > 1 reads and hashes the files in a thread pool, the results
+        # are still written to the repository by the calling thread
+        self.workers = workers
+        self.max_inflight_bytes = max_inflight_bytes
+        # pipeline=True samples and hashes the files while the directories
+        # are still being walked, see insert_files_pipelined
+        self.pipeline = pipeline
+        # (hash, size) of the files hashed while iter_clusters runs
+        self.updated_groups = None
+        # time.monotonic() after which no more files are sampled or hashed.
+        # The files are hashed by their potential savings, so the scan ends
+        # with the biggest groups found, and a later scan hashes the rest
+        self.deadline = deadline
+        # the size groups of up to compare_max_files files are compared byte
+        # by byte instead of hashed, see _compare_groups
+        self.compare_max_files = compare_max_files
 
     @log_time
-    def insert_files(self, path):
-        for file_name, file_size, file_abspath, realpath in self.get_files(path):
-            logging.debug(
-                'inserting filename %s in path %s with abspath %s, realpath %s and size %s',
-                file_name, path, file_abspath, realpath, str(file_size)
-            )
-            self.repository.add_file(name=file_name, size=file_size, path=path, abspath=file_abspath, realpath=realpath)
+    def insert_files(self, path, scan_id=None):
+        count = self.repository.add_files(self._rows(path, self.get_files(path)), scan_id=scan_id)
+        logging.info('%s files indexed from %s', count, path)
+
+    @log_time
+    def insert_files_pipelined(self, path, scan_id=None):
+        for _ in self._insert_files_pipelined(path, scan_id):
+            pass
+
+    def _insert_files_pipelined(self, path, scan_id):
+        # insert_files overlapped with the sampling and hashing: the walk runs
+        # ahead in its own thread, every batch of files is inserted as soon as
+        # the walk stops to list a directory or BATCH_SIZE files arrive, and
+        # the candidates of the batch are handed to the workers. The walk
+        # waits for the inserts once WALK_QUEUE_SIZE files are queued, and the
+        # inserts wait for the workers once max_inflight_bytes are being read.
+        # update_checksum finishes the files that weren't decided here, e.g.
+        # the ones with a size group in another root
+        stats = pipeline_stats()
+        if isinstance(self.get_files, incremental_walker):
+            # it uses the repository, so it can't leave this thread
+            walked = self._walk_inline(path, stats)
+        else:
+            walked = self._walk_ahead(path, stats)
+
+        count = 0
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            hashing = _hashing_pipeline(self, executor, stats)
+            for batch in self._batches(self._rows(path, walked)):
+                start = perf_counter()
+                count += self.repository.add_files(batch, scan_id=scan_id)
+                stats.add('insert', len(batch), 0, perf_counter() - start)
+                hashing.add(batch)
+                for _ in hashing.results(wait=False):
+                    yield
+                yield
+            for _ in hashing.results(wait=True):
+                yield
+
+        self.repository.commit()
+        logging.info('%s files indexed from %s', count, path)
+        stats.log(path)
+
+    def _rows(self, path, files):
+        # get_files may leave out the trailing mtime_ns, dev, ino and dir_id.
+        # None passes through, see _walk_ahead
+        for file_data in files:
+            if file_data is None:
+                yield None
+            else:
+                yield (file_data[0], file_data[1], path, file_data[2], file_data[3]) + \
+                    tuple(file_data[4:8]) + (None,) * (8 - len(file_data))
+
+    def _batches(self, rows):
+        # None ends a batch early, so the files are inserted while the walk
+        # is busy
+        batch = []
+        for row in rows:
+            if row is not None:
+                batch.append(row)
+            if batch and (row is None or len(batch) >= BATCH_SIZE):
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _walk_inline(self, path, stats):
+        files = iter(self.get_files(path))
+        while True:
+            start = perf_counter()
+            file_data = next(files, None)
+            if file_data is None:
+                return
+            stats.add('walk', 1, file_data[1] or 0, perf_counter() - start)
+            yield file_data
+
+    def _walk_ahead(self, path, stats):
+        # Yields the files of get_files(path) walked by another thread, at
+        # most WALK_QUEUE_SIZE files ahead. None is yielded every time the
+        # queue runs empty
+        walked = queue.Queue(maxsize=WALK_QUEUE_SIZE)
+        stopped = threading.Event()
+        done = object()
+
+        def walk():
+            try:
+                busy = perf_counter()
+                for file_data in self.get_files(path):
+                    start = perf_counter()
+                    stats.add('walk', 1, file_data[1] or 0, start - busy)
+                    walked.put(file_data)
+                    busy = perf_counter()
+                    if stopped.is_set():
+                        return
+                walked.put(done)
+            except BaseException as e:
+                walked.put(e)
+
+        walker = threading.Thread(target=walk, name='walk ' + path)
+        walker.daemon = True
+        walker.start()
+        try:
+            while True:
+                try:
+                    file_data = walked.get_nowait()
+                except queue.Empty:
+                    yield None
+                    file_data = walked.get()
+                if file_data is done:
+                    return
+                if isinstance(file_data, BaseException):
+                    raise file_data
+                yield file_data
+        finally:
+            # the consumer may stop early, unblock the walk so it can see it
+            stopped.set()
+            while walker.is_alive():
+                try:
+                    walked.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    @log_time
+    def update_sample(self):
+        # the sample of a small file costs as much as its full checksum
+        candidates = self._until_deadline(
+            (size, name)
+            for size, name in self.repository.findBy_duplicate_size(before_state=STATE_SAMPLED, one_per_inode=True)
+            if size > 2 * self.sample_size
+        )
+        for size, name, sample in self._map(self._sample, candidates):
+            logging.debug('updating sample %s for file %s', sample, name)
+            self.repository.update_sample(name, sample=sample)
 
     @log_time
     def update_checksum(self):
-        for bysize_size, bysize_name in self.repository.findBy_duplicate_size():
-            hash_value = self.hash_function(bysize_name)
-            logging.debug(
-                'updating hash %s for file %s', hash_value, bysize_name)
-            self.repository.update_file(bysize_name, hash=hash_value)
+        for _ in self._update_checksum():
+            pass
+
+    def _update_checksum(self):
+        # yields after every file is hashed. Only the files that weren't
+        # hashed yet, by this or a previous scan, and a single name of every
+        # inode
+        copied = self.repository.copy_hardlink_hashes()
+        logging.info('%s hashes copied from hardlinks', copied)
+        for _ in self._compare_groups():
+            yield
+
+        if self.sample_function is None:
+            candidates = self.repository.findBy_duplicate_size(before_state=STATE_HASHED, one_per_inode=True)
+        else:
+            self.update_sample()
+            candidates = self.repository.findBy_duplicate_sample(before_state=STATE_HASHED, one_per_inode=True)
+
+        candidates = self._not_cached(self._until_deadline(candidates))
+        if self.cache_policy is not None and self.cache_policy.prefetch:
+            candidates = self._prefetch(candidates)
+
+        for size, name, key, hash_value in self._map(self.hash_function, candidates):
+            if key is not None and hash_value is not None:
+                self.cache.add(self.algorithm, key, hash_value)
+            self._update_file(size, name, hash_value)
+            yield
+
+        if self.cache_policy is not None:
+            logging.info(
+                '%s bytes dropped from and %s bytes prefetched into the page cache',
+                self.cache_policy.dropped_bytes, self.cache_policy.prefetched_bytes
+            )
+
+    def _compare_groups(self):
+        # Compares the files of the small size groups, yielding after every
+        # group. The whole group is compared again when a file joins it, and
+        # it is hashed instead once it has more than compare_max_files files
+        reset = self.repository.reset_compared(self.compare_max_files)
+        logging.info('%s compared files left for hashing', reset)
+        if not self.compare_max_files:
+            return
+
+        rows = self.repository.findBy_small_size_group(self.compare_max_files, one_per_inode=True)
+        groups = self._until_deadline(
+            # (bytes, names, size), so _map limits the bytes being compared
+            (size * len(names), names, size)
+            for size, names in (
+                (size, tuple(row['fullname'] for row in group))
+                for size, group in groupby(rows, lambda row: row['size'])
+            )
+        )
+        for group_bytes, names, size, identical in self._map(compare_files, groups):
+            compared = set()
+            for index, same in enumerate(identical):
+                for name in same:
+                    self._update_file(size, name, COMPARED_LABEL.format(index), STATE_COMPARED)
+                compared.update(same)
+            for name in set(names) - compared:
+                # it couldn't be read
+                self._update_file(size, name, None, STATE_COMPARED)
+            yield
+
+    def _past_deadline(self):
+        return self.deadline is not None and monotonic() >= self.deadline
+
+    def _until_deadline(self, candidates):
+        for candidate in candidates:
+            if self._past_deadline():
+                logging.warning('Deadline reached, the files left will be hashed by the next scan')
+                return
+            yield candidate
+
+    def _not_cached(self, candidates):
+        for size, name in candidates:
+            key = _cache_key(name) if self.cache is not None else None
+            hash_value = self.cache.find(self.algorithm, key) if key is not None else None
+            if hash_value is not None:
+                self._update_file(size, name, hash_value)
+            else:
+                yield size, name, key
+
+    def _prefetch(self, candidates):
+        # the file after the one being pulled is read ahead by the kernel
+        # while the current one is hashed
+        candidates = iter(candidates)
+        current = next(candidates, None)
+        while current is not None:
+            following = next(candidates, None)
+            if following is not None:
+                self.cache_policy.will_read(following[1])
+            yield current
+            current = following
+
+    def _update_file(self, size, name, hash_value, state=STATE_HASHED):
+        logging.debug('updating hash %s for file %s', hash_value, name)
+        self.repository.update_file(name, hash_value, state)
+        if self.updated_groups is not None and hash_value is not None:
+            self.updated_groups.append((hash_value, size))
+
+    def _sample(self, name):
+        return self.sample_function(name, self.sample_size)
+
+    def _map(self, function, candidates):
+        # Yields every candidate tuple, (size, name, ...), followed by
+        # function(name), in candidate order. With several workers up to
+        # max_inflight_bytes of files are being read at the same time, a file
+        # bigger than that is read alone
+        if self.workers <= 1:
+            for candidate in candidates:
+                yield candidate + (function(candidate[1]),)
+            return
+
+        inflight = deque()
+        inflight_bytes = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for candidate in candidates:
+                size = candidate[0] or 0
+                while inflight and (inflight_bytes + size > self.max_inflight_bytes or
+                                    len(inflight) >= 4 * self.workers):
+                    done, future = inflight.popleft()
+                    inflight_bytes -= done[0] or 0
+                    yield done + (future.result(),)
+
+                inflight.append((candidate, executor.submit(function, candidate[1])))
+                inflight_bytes += size
+
+            while inflight:
+                done, future = inflight.popleft()
+                yield done + (future.result(),)
 
     def _clean_input(self, source_list):
         def has_subdirs(d, l):
@@ -285,28 +2128,72 @@ class DupScanner():
 
     @log_time
     def scan(self, directory_list):
+        for _ in self._scan(directory_list):
+            pass
+
+    def _scan(self, directory_list):
+        # yields every time a file may have been hashed
         for directory in directory_list:
             if not os.path.isdir(directory):
                 raise AssertionError('%s is not a directory' % directory)
 
+        # files indexed by a previous scan keep their checksums if they didn't
+        # change, and the ones that are gone are removed
+        scan_id = self.repository.start_scan(self.algorithm)
+
         directory_list = self._clean_input(directory_list)
         for directory in directory_list:
             logging.info('start scan of directory %s', directory)
-            self.insert_files(directory)
-            self.update_checksum()
+            if self.pipeline:
+                for _ in self._insert_files_pipelined(directory, scan_id):
+                    yield
+            else:
+                self.insert_files(directory, scan_id)
+            self.repository.delete_missing(directory, scan_id)
+        self.repository.finish_scan(scan_id)
+
+        # after every root is inserted, so each file is hashed at most once
+        for _ in self._update_checksum():
+            yield
+
+    def iter_clusters(self, path_list, skip_hardlinks=False):
+        # Scans path_list and yields a cluster as soon as a group of
+        # duplicates is confirmed, instead of waiting for the whole scan.
+        # A group is yielded again every time it grows, the last cluster
+        # yielded for a (hash, size) is the complete one. The groups that
+        # were already hashed by a previous scan are yielded once the scan
+        # is over
+        yielded = {}
+        self.updated_groups = []
+        try:
+            for _ in self._scan(path_list):
+                while self.updated_groups:
+                    hash_value, size = self.updated_groups.pop()
+                    found = cluster.of(self.repository.findBy_cluster(hash_value, size, skip_hardlinks))
+                    if found is not None and yielded.get((hash_value, size)) != found.paths:
+                        yielded[(hash_value, size)] = found.paths
+                        yield found
+        finally:
+            self.updated_groups = None
+
+        rows = self.repository.findBy_duplicate_hash(skip_hardlinks)
+        for (hash_value, size), files in groupby(rows, lambda row: (row['hash'], row['size'])):
+            found = cluster(hash_value, size, tuple(files))
+            if yielded.get((hash_value, size)) != found.paths:
+                yield found
 
     # TODO: Move these functions to the cli
     @log_time
-    def find_duplicates(self, path_list):
-        return self._find(path_list, self.repository.findBy_duplicate_hash)
+    def find_duplicates(self, path_list, skip_hardlinks=False):
+        return self._find(path_list, self.repository.findBy_duplicate_hash, skip_hardlinks)
 
     @log_time
-    def find_unique(self, path_list):
-        return self._find(path_list, self.repository.findBy_unique_hash)
+    def find_unique(self, path_list, skip_hardlinks=False):
+        return self._find(path_list, self.repository.findBy_unique_hash, skip_hardlinks)
 
-    def _find(self, path_list, search_method):
+    def _find(self, path_list, search_method, skip_hardlinks=False):
         self.scan(path_list)
 
-        return search_method()
+        return search_method(skip_hardlinks)
         # for data in search_method():
         #  yield data
@@ -0,0 +1,86 @@
+#! /usr/bin/env python
+# Times the repository finders on synthetic files tables. Roughly a third of
+# the rows share their size and hash with other rows, and one in five has a
+# hash of its own. --legacy also times the correlated EXISTS queries the
+# finders used to run.
+#
+#   python query_benchmark.py --rows 100000 1000000 10000000
+#   python query_benchmark.py --rows 100000 --legacy
+#   python query_benchmark.py --rows 1000000 --database /tmp/files.db --db-profile bulk-ingest
+from __future__ import print_function
+
+import argparse
+from timeit import default_timer
+
+from dupscanner import connection_factory, repository, DB_PROFILES
+
+LEGACY = {
+    'findBy_duplicate_hash':
+        'select hash, size, fullname, path, abspath from files f '
+        'where exists ('
+        '  select 1 from files f2 '
+        '  where f.size = f2.size and f.hash = f2.hash and f.realpath <> f2.realpath'
+        ') order by hash, size, fullname',
+    'findBy_unique_hash':
+        'select hash, size, fullname, path, abspath from files f '
+        'where f.hash is null or f.size is null or not exists ('
+        '  select 1 from files f2 '
+        '  where f.size = f2.size and f.hash = f2.hash and f.realpath <> f2.realpath'
+        ') order by f.hash, f.size',
+    'findBy_duplicate_size':
+        'select size, fullname from files f '
+        'where exists ('
+        '  select 1 from files f2 where f.size = f2.size and f.realpath <> f2.realpath'
+        ') order by f.hash, f.size',
+}
+
+
+def populate(conn, rows):
+    groups = max(1, rows // 3)
+    conn.execute(
+        'WITH RECURSIVE seq(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM seq WHERE i < ?) '
+        'INSERT INTO files(fullname, size, hash, path, abspath, realpath) '
+        'SELECT '
+        '  \'/data/\' || i, '
+        '  i % ?, '
+        '  CASE WHEN i % 5 = 0 THEN \'u\' || i ELSE \'h\' || (i % ?) END, '
+        '  \'/data/\', '
+        '  \'/data/\' || i, '
+        '  \'/data/\' || i '
+        'FROM seq',
+        (rows, groups, groups)
+    )
+    conn.commit()
+
+
+def timed(query):
+    start = default_timer()
+    count = sum(1 for _ in query())
+    return count, default_timer() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", help="Table sizes to benchmark", type=int, nargs='+', default=[100000, 1000000])
+    parser.add_argument("--database", help="SQLite database for the tables", default=":memory:")
+    parser.add_argument("--legacy", help="Also time the correlated EXISTS queries", action="store_true")
+    parser.add_argument("--db-profile", help="SQLite settings", default='default', choices=sorted(DB_PROFILES))
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        with connection_factory(args.database, args.db_profile) as conn, repository(conn) as repo:
+            conn.execute('DELETE FROM files')
+            start = default_timer()
+            populate(conn, rows)
+            print('%d rows inserted in %.3fs' % (rows, default_timer() - start))
+
+            for name in ('findBy_duplicate_hash', 'findBy_unique_hash', 'findBy_duplicate_size'):
+                count, elapsed = timed(getattr(repo, name))
+                print('  %-24s %10d rows %10.3fs' % (name, count, elapsed))
+                if args.legacy:
+                    count, elapsed = timed(lambda: conn.execute(LEGACY[name]))
+                    print('  %-24s %10d rows %10.3fs' % ('  legacy', count, elapsed))
+
+
+if '__main__' == __name__:
+    main()
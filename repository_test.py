@@ -2,7 +2,11 @@ import unittest
 import tempfile
 import shutil
 import logging
-from os import path, makedirs, urandom, chmod, symlink, remove
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from os import path, makedirs, urandom, chmod, symlink, link, remove, utime, scandir
 
 from sys import version_info
 if version_info >= (3,4):
@@ -10,7 +14,10 @@ if version_info >= (3,4):
 else:
     from mock import patch
 
-from dupscanner import connection_factory, repository, DupScanner
+from dupscanner import connection_factory, repository, memory_repository, checksum_cache, DupScanner, \
+    _get_files, _scandir_files, parallel_walker, incremental_walker, _md5_checksum, _sample_checksum, \
+    SCHEMA_MIGRATIONS, DB_PROFILES, STATE_NEW, STATE_HASHED, STATE_COMPARED, REALPATH
+from checksums import checksum
 
 logging.basicConfig(level='DEBUG')
 
@@ -129,7 +136,26 @@ class DataGenerator():
         return abs_dest_fullname
 
 
+def sqlite_only(test):
+    # the test looks into the SQLite database behind the repository
+    @wraps(test)
+    def wrapper(self):
+        if self.backend != 'sqlite':
+            self.skipTest('SQLite backend only')
+        return test(self)
+    return wrapper
+
+
 class TestRepository(unittest.TestCase):
+    # Every test runs against the SQLite repository, and against
+    # memory_repository in TestMemoryRepository
+
+    backend = 'sqlite'
+
+    @contextmanager
+    def open_repository(self, database):
+        with connection_factory(database) as conn, repository(conn) as repo:
+            yield repo
 
     def test_happy_path(self):
         with DataGenerator() as test_scenario:
@@ -151,7 +177,7 @@ class TestRepository(unittest.TestCase):
             uniques_expected.add(test_scenario.create_file('4/xx.data', size=2048, readable=False))
 
             connection_string = ':memory:'
-            with connection_factory(connection_string) as conn, repository(conn) as repo:
+            with self.open_repository(connection_string) as repo:
                 DupScanner(repo).scan((test_scenario.root_path,))
 
                 duplicates_found = {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
@@ -198,7 +224,7 @@ class TestRepository(unittest.TestCase):
             uniques_expected.add(test_scenario.create_file('4/xx.data', size=2048, readable=False))
 
             connection_string = ':memory:'
-            with connection_factory(connection_string) as conn, repository(conn) as repo:
+            with self.open_repository(connection_string) as repo:
                 DupScanner(repo).scan((test_scenario.root_path,  test_scenario.abs_path('1/')))
 
                 duplicates_found = {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
@@ -246,7 +272,7 @@ class TestRepository(unittest.TestCase):
             ignored_links.add(test_scenario.symlink('4/xx.data', '4/lnk-xx.data'))
 
             connection_string = ':memory:'
-            with connection_factory(connection_string) as conn, repository(conn) as repo:
+            with self.open_repository(connection_string) as repo:
                 DupScanner(repo).scan((test_scenario.root_path,))
 
                 duplicates_found = {fullname for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
@@ -302,7 +328,7 @@ class TestRepository(unittest.TestCase):
             uniques_expected.add(path.join(test_scenario.root_path, 'links/1/xx.data'))
 
             connection_string = ':memory:'
-            with connection_factory(connection_string) as conn, repository(conn) as repo:
+            with self.open_repository(connection_string) as repo:
                 # DupScanner(repo).scan((test_scenario.root_path,))
                 DupScanner(repo).scan((
                     path.join(test_scenario.root_path, '1'),
@@ -343,8 +369,7 @@ class TestRepository(unittest.TestCase):
             test_scenario.create_duplicates(duplicates, size=10)
 
             connection_string = ':memory:'
-            with connection_factory(connection_string) as conn, \
-                    repository(conn) as repo, patch('os.remove') as mock_path:
+            with self.open_repository(connection_string) as repo, patch('os.remove') as mock_path:
 
                 DupScanner(repo).scan((test_scenario.root_path,))
 
@@ -364,6 +389,635 @@ class TestRepository(unittest.TestCase):
 
                 assert not mock_path.called, 'File should have not been deleted'
                 mock_path.reset_mock
+    def test_scandir_files_matches_walk(self):
+        with DataGenerator() as test_scenario:
+            test_scenario.create_duplicates(('1/a.data', '2/a.data', '3/3/a.data'), size=4097)
+            test_scenario.create_file('1/b.data', size=0)
+            test_scenario.create_file('4/x.data', size=2048, readable=False)
+            test_scenario.symlink('1/a.data', '2/lnk-a.data')
+            test_scenario.symlink('3/', 'links/3')
+
+            for root in (test_scenario.root_path, path.join(test_scenario.root_path, 'links', '')):
+                expected = sorted(_get_files(root))
+                found = sorted(_scandir_files(root))
+
+                assert expected == found, \
+                    'scandir walker doesn\'t match os.walk. \n Expected: {}\n Found: {}'.format(expected, found)
+    def test_parallel_walker(self):
+        with DataGenerator() as test_scenario:
+            for d in range(10):
+                test_scenario.create_duplicates(('%s/a.data' % d, '%s/%s/a.data' % (d, d)), size=d)
+            test_scenario.symlink('1/a.data', '2/lnk-a.data')
+            test_scenario.symlink('3/', 'links/3')
+
+            expected = list(_scandir_files(test_scenario.root_path))
+
+            ordered = list(parallel_walker(threads=4, ordered=True)(test_scenario.root_path))
+            assert expected == ordered, \
+                'Ordered walk doesn\'t match. \n Expected: {}\n Found: {}'.format(expected, ordered)
+
+            unordered = list(parallel_walker(threads=4)(test_scenario.root_path))
+            assert sorted(expected) == sorted(unordered), \
+                'Unordered walk doesn\'t match. \n Expected: {}\n Found: {}'.format(expected, unordered)
+    def test_checksum_cache(self):
+        with DataGenerator() as test_scenario:
+            duplicates_expected = test_scenario.create_duplicates(('1/a.data', '2/a.data', '3/a.data'), size=4097)
+            modified = test_scenario.abs_path('3/a.data')
+
+            hashed = []
+
+            def hash_function(file_name):
+                hashed.append(file_name)
+                return _md5_checksum(file_name)
+
+            def scan(cache):
+                with self.open_repository(':memory:') as repo:
+                    DupScanner(repo, hash_function=hash_function, cache=cache).scan((test_scenario.root_path,))
+                    return {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+
+            with connection_factory(':memory:') as cache_conn, checksum_cache(cache_conn) as cache:
+                assert duplicates_expected == scan(cache)
+                assert set(hashed) == duplicates_expected, 'Every candidate should be hashed on the first run'
+
+                del hashed[:]
+                assert duplicates_expected == scan(cache)
+                assert not hashed, 'Unchanged files should not be hashed again: {}'.format(hashed)
+
+                utime(modified, (0, 0))
+                assert duplicates_expected == scan(cache)
+                assert hashed == [modified], 'Only the modified file should be hashed again: {}'.format(hashed)
+    def test_sample_discards_candidates(self):
+        with DataGenerator() as test_scenario:
+            duplicates_expected = test_scenario.create_duplicates(('1/a.data', '2/a.data'), size=20000)
+            duplicates_expected |= test_scenario.create_duplicates(('1/aa.data', '2/aa.data'), size=100)
+            different_head = {test_scenario.create_file('1/b.data', size=20000),
+                              test_scenario.create_file('2/b.data', size=20000)}
+
+            # same head and tail as the duplicates, different middle
+            different_middle = test_scenario.copy_file('1/a.data', '3/a.data')
+            with open(different_middle, 'r+b') as f:
+                f.seek(10000)
+                middle = f.read(1)
+                f.seek(10000)
+                f.write(bytes(bytearray([(ord(middle) + 1) % 256])))
+
+            hashed = []
+
+            def hash_function(file_name):
+                hashed.append(file_name)
+                return _md5_checksum(file_name)
+
+            with self.open_repository(':memory:') as repo:
+                DupScanner(repo, hash_function=hash_function).scan((test_scenario.root_path,))
+
+                duplicates_found = {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+                assert duplicates_expected == duplicates_found, \
+                    'Expected duplicate set doesn\'t match found set. \n Expected: {}\n Found: {}'.format(duplicates_expected, duplicates_found)
+
+                assert not different_head & set(hashed), 'Files with a different sample should not be hashed'
+                assert set(hashed) == duplicates_expected | {different_middle}, \
+                    'Unexpected files were hashed: {}'.format(hashed)
+    def test_concurrent_checksum(self):
+        with DataGenerator() as test_scenario:
+            duplicates_expected = set()
+            for d in range(6):
+                duplicates_expected |= test_scenario.create_duplicates(
+                    ('1/%s.data' % d, '2/%s.data' % d), size=1000 + d)
+            uniques_expected = {test_scenario.create_file('3/%s.data' % d, size=1000 + d) for d in range(6)}
+
+            lock = threading.Lock()
+            inflight = [0, 0]  # current and max bytes being hashed
+
+            def hash_function(file_name):
+                size = path.getsize(file_name)
+                with lock:
+                    inflight[0] += size
+                    inflight[1] = max(inflight)
+                time.sleep(0.01)
+                with lock:
+                    inflight[0] -= size
+                return _md5_checksum(file_name)
+
+            with self.open_repository(':memory:') as repo:
+                DupScanner(
+                    repo, hash_function=hash_function, workers=4, max_inflight_bytes=2500
+                ).scan((test_scenario.root_path,))
+
+                duplicates_found = {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+                assert duplicates_expected == duplicates_found, \
+                    'Expected duplicate set doesn\'t match found set. \n Expected: {}\n Found: {}'.format(duplicates_expected, duplicates_found)
+
+                uniques_found = {abspath for hash, size, fullname, path, abspath in repo.findBy_unique_hash()}
+                assert uniques_expected == uniques_found, \
+                    'Expected unique set doesn\'t match found set. \n Expected: {}\n Found: {}'.format(uniques_expected, uniques_found)
+
+                assert 1000 < inflight[1] <= 2500, 'In flight bytes limit not honored: {}'.format(inflight[1])
+    def test_checksum_cache_algorithms(self):
+        with DataGenerator() as test_scenario:
+            test_scenario.create_duplicates(('1/a.data', '2/a.data'), size=4097)
+
+            def scan(cache, hash_function):
+                with self.open_repository(':memory:') as repo:
+                    DupScanner(repo, hash_function=hash_function, cache=cache).scan((test_scenario.root_path,))
+                    return {hash for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+
+            with connection_factory(':memory:') as cache_conn, checksum_cache(cache_conn) as cache:
+                md5 = scan(cache, checksum('md5'))
+                sha1 = scan(cache, checksum('sha1'))
+
+                assert len(md5) == 1 and len(sha1) == 1 and md5 != sha1, \
+                    'Cached checksums were mixed between algorithms: {} {}'.format(md5, sha1)
+                assert md5 == scan(cache, checksum('md5'))
+
+    @sqlite_only
+    def test_add_files(self):
+        files = [('/data/%s/a.data' % i, i % 2, '/data', '/data/%s/a.data' % i, '/data/%s/a.data' % i, i,
+                  1, 100 + i, None)
+                 for i in range(5)]
+        # a fullname that isn't the path of the file under /data, a symlink
+        # and a file without realpath
+        files[2] = ('other/2/a.data',) + files[2][1:]
+        files[3] = files[3][:4] + ('/backup/3/a.data',) + files[3][5:]
+        files[4] = files[4][:4] + (None,) + files[4][5:]
+
+        with connection_factory(':memory:') as conn, repository(conn) as repo:
+            assert 5 == repo.add_files(iter(files), batch_size=2)
+
+            # the fullname and the realpath are only stored when they can't
+            # be derived from the path
+            found = [tuple(row) for row in conn.execute(
+                'select name, fullname, real_dir_id, real_name, size, mtime_ns, dev, ino from files order by id')]
+            expected = [
+                ('a.data', None, None, None, 0, 0, 1, 100),
+                ('a.data', None, None, None, 1, 1, 1, 101),
+                ('a.data', 'other/2/a.data', None, None, 0, 2, 1, 102),
+                ('a.data', None, repo._directory_id('/backup/3', create=False), 'a.data', 1, 3, 1, 103),
+                ('a.data', None, 0, None, 0, 4, 1, 104),
+            ]
+            assert expected == found, 'Inserted files don\'t match. \n Expected: {}\n Found: {}'.format(expected, found)
+
+            for name, size, path, abspath, realpath, mtime_ns, dev, ino, dir_id in files:
+                repo.update_file(name, b'h')
+            assert [
+                (b'h', 0, '/data/0/a.data', '/data', '/data/0/a.data'),
+                (b'h', 0, 'other/2/a.data', '/data', '/data/2/a.data'),
+                (b'h', 1, '/data/1/a.data', '/data', '/data/1/a.data'),
+                (b'h', 1, '/data/3/a.data', '/data', '/data/3/a.data'),
+            ] == [tuple(row) for row in repo.findBy_duplicate_hash()]
+
+    @sqlite_only
+    def test_schema_migrations(self):
+        with DataGenerator() as test_scenario:
+            database = test_scenario.abs_path('files.db')
+
+            with connection_factory(database) as conn, repository(conn) as repo:
+                repo.add_file('a.data', 1, 'c:/path1', 'c:/path1/a.data', 'c:/path1/a.data')
+                assert len(SCHEMA_MIGRATIONS) == conn.execute('PRAGMA user_version').fetchone()[0]
+
+            # an up to date database is reused as it is
+            with connection_factory(database) as conn, repository(conn) as repo:
+                assert [('a.data',)] == [tuple(row) for row in conn.execute('select fullname from files')]
+
+    @sqlite_only
+    def test_data_migrations(self):
+        with DataGenerator() as test_scenario:
+            database = test_scenario.abs_path('files.db')
+
+            # an index from before digests were stored as BLOBs and paths
+            # were stored by directory
+            with connection_factory(database) as conn:
+                for statements in SCHEMA_MIGRATIONS[:7]:
+                    for statement in statements:
+                        conn.execute(statement)
+                conn.execute('PRAGMA user_version = 7')
+                conn.executemany(
+                    'INSERT INTO files(fullname, size, path, abspath, realpath, sample, hash, state) '
+                    'VALUES(?,?,?,?,?,?,?,?)', [
+                        ('/data/a.data', 1, '/data', '/data/a.data', '/data/a.data', 'ab01', 'cd02', STATE_HASHED),
+                        ('/data/b.data', 1, '/data', '/data/b.data', '/data/a.data', 'ab01', 'compared-0', STATE_COMPARED),
+                        ('c.data', 1, '/data', '/data/c.data', None, None, None, STATE_NEW),
+                    ])
+
+            with connection_factory(database) as conn, repository(conn) as repo:
+                assert len(SCHEMA_MIGRATIONS) == conn.execute('PRAGMA user_version').fetchone()[0]
+                data = repo._directory_id('/data', create=False)
+                found = [tuple(row) for row in conn.execute(
+                    'select dir_id, name, fullname, real_dir_id, real_name, sample, hash from files order by name')]
+                assert [
+                    (data, 'a.data', None, None, None, b'\xab\x01', b'\xcd\x02'),
+                    (data, 'b.data', None, data, 'a.data', b'\xab\x01', 'compared-0'),
+                    (data, 'c.data', 'c.data', 0, None, None, None),
+                ] == found
+                assert [('/data/a.data', 1, b'\xcd\x02', '/data', '/data/a.data')] == \
+                    [tuple(row) for row in repo.findBy_hash_size(b'\xcd\x02', 1)]
+
+    @sqlite_only
+    def test_db_profiles(self):
+        with DataGenerator() as test_scenario:
+            for profile in sorted(DB_PROFILES):
+                database = test_scenario.abs_path('%s.db' % profile)
+                with connection_factory(database, profile) as conn, repository(conn) as repo:
+                    repo.add_file('a.data', 1, 'c:/path1', 'c:/path1/a.data', 'c:/path1/a.data')
+                    for name, value in DB_PROFILES[profile]:
+                        found = conn.execute('PRAGMA {}'.format(name)).fetchone()[0]
+                        # the values read back for the symbolic ones
+                        expected = {'WAL': 'wal', 'OFF': 0, 'NORMAL': 1, 'FULL': 2, 'FILE': 1, 'MEMORY': 2}.get(value, value)
+                        assert expected == found, '{} {}: expected {}, found {}'.format(profile, name, expected, found)
+
+                # the settings that are kept in the file don't get in the way of
+                # another profile
+                with connection_factory(database, 'durable') as conn, repository(conn) as repo:
+                    assert [('a.data',)] == [tuple(row) for row in conn.execute('select fullname from files')]
+
+            self.assertRaises(ValueError, connection_factory, ':memory:', 'fast')
+
+    def _query_plans(self, conn, action):
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            action()
+        finally:
+            conn.set_trace_callback(None)
+
+        return [
+            ' '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + statement))
+            for statement in statements
+            if statement.split()[0].lower() in ('select', 'delete', 'update')
+        ]
+
+    @sqlite_only
+    def test_query_plans_use_indexes(self):
+        with DataGenerator() as test_scenario:
+            duplicates = test_scenario.create_duplicates(('1/a.data', '2/a.data'), size=10)
+            test_scenario.create_file('1/b.data', size=10)
+
+            with connection_factory(':memory:') as conn, repository(conn) as repo, patch('os.remove'):
+                DupScanner(repo).scan((test_scenario.root_path,))
+                hash, size = next(iter(repo.findBy_duplicate_hash()))[:2]
+
+                finders = {
+                    'findBy_duplicate_size': (lambda: list(repo.findBy_duplicate_size()), 'INDEX files_size_'),
+                    'findBy_duplicate_sample': (lambda: list(repo.findBy_duplicate_sample()), 'INDEX files_size_'),
+                    'findBy_duplicate_hash': (lambda: list(repo.findBy_duplicate_hash()), 'INDEX files_size_hash'),
+                    'findBy_unique_hash': (lambda: list(repo.findBy_unique_hash()), 'INDEX files_size_hash'),
+                    'findBy_hash_size': (lambda: list(repo.findBy_hash_size(hash, size)), 'INDEX files_size_hash'),
+                    # the file is found by its directory and name, and then
+                    # by its id
+                    'delete_file': (lambda: repo.delete_file(sorted(duplicates)[0]), 'SEARCH '),
+                }
+                for name, (action, index) in finders.items():
+                    plans = self._query_plans(conn, action)
+                    assert plans, '{} executed no query'.format(name)
+                    for plan in plans:
+                        assert index in plan, '{} doesn\'t use {}: {}'.format(name, index, plan)
+                        assert name != 'delete_file' or 'SCAN ' not in plan, '{} scans a table: {}'.format(name, plan)
+    def test_finders_null_semantics(self):
+        rows = [
+            #filename     #size   #hash   #realpath
+            ('dup-a',     1,      'h1',   'r1'),
+            ('dup-b',     1,      'h1',   'r2'),
+            ('dup-link',  1,      'h1',   'r2'),
+            ('no-real',   1,      'h1',   None),
+            ('same-real', 2,      'h2',   'r3'),
+            ('same-real', 2,      'h2',   'r3'),
+            ('diff-hash', 2,      'h3',   'r4'),
+            ('no-hash-a', 3,      None,   'r5'),
+            ('no-hash-b', 3,      None,   'r6'),
+            ('no-size-a', None,   'h4',   'r7'),
+            ('no-size-b', None,   'h4',   'r8'),
+        ]
+        correlated = \
+            'select fullname from files f ' \
+            'where {} exists (' \
+            '  select 1 from files f2 ' \
+            '  where f.size = f2.size and f.hash = f2.hash and {} <> {}' \
+            ')'
+
+        with self.open_repository(':memory:') as repo:
+            for i, (name, size, hash, realpath) in enumerate(rows):
+                repo.add_file('%s-%s' % (name, i), size, 'c:/path', 'c:/path/%s' % i, realpath)
+                repo.update_file('%s-%s' % (name, i), hash)
+
+            duplicates = [row[2] for row in repo.findBy_duplicate_hash()]
+            uniques = [row[2] for row in repo.findBy_unique_hash()]
+
+            assert sorted(duplicates) == duplicates, 'Duplicates are not sorted: {}'.format(duplicates)
+            if self.backend == 'sqlite':
+                conn = repo.connection
+                realpaths = REALPATH.format(f='f'), REALPATH.format(f='f2')
+                assert set(duplicates) == {row[0] for row in conn.execute(correlated.format('', *realpaths))}
+                assert set(uniques) == {row[0] for row in conn.execute(correlated.format('not', *realpaths))}
+            assert {'dup-a-0', 'dup-b-1', 'dup-link-2'} == set(duplicates)
+            assert {'%s-%s' % (row[0], i) for i, row in enumerate(rows)} - set(duplicates) == set(uniques)
+    def test_hash_each_file_once(self):
+        with DataGenerator() as test_scenario:
+            duplicates_expected = set()
+            for d in range(4):
+                duplicates_expected |= test_scenario.create_duplicates(
+                    ['%s/%s.data' % (root, d) for root in range(4)], size=20000 + d)
+
+            roots = [test_scenario.abs_path(str(root)) for root in range(4)]
+            hashed = []
+
+            def hash_function(file_name):
+                hashed.append(file_name)
+                if len(hashed) == 5:
+                    raise KeyboardInterrupt()
+                return _md5_checksum(file_name)
+
+            with self.open_repository(':memory:') as repo:
+                scanner = DupScanner(repo, hash_function=hash_function)
+                self.assertRaises(KeyboardInterrupt, scanner.scan, roots)
+
+                # the interrupted file is hashed again, nothing else
+                scanner.update_checksum()
+                scanner.update_checksum()
+
+                duplicates_found = {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+                assert duplicates_expected == duplicates_found, \
+                    'Expected duplicate set doesn\'t match found set. \n Expected: {}\n Found: {}'.format(duplicates_expected, duplicates_found)
+
+                assert len(duplicates_expected) + 1 == len(hashed), 'Files were hashed more than once: {}'.format(hashed)
+                assert duplicates_expected == set(hashed)
+
+    def test_incremental_scan(self):
+        with DataGenerator() as test_scenario:
+            database = test_scenario.abs_path('index.db')
+            scanned = test_scenario.abs_path('data')
+            duplicates = test_scenario.create_duplicates(('data/1/a.data', 'data/2/a.data', 'data/3/a.data'), size=20000)
+            modified = test_scenario.abs_path('data/3/a.data')
+            removed = test_scenario.create_duplicates(('data/1/b.data', 'data/2/b.data'), size=100)
+
+            hashed = []
+
+            def hash_function(file_name):
+                hashed.append(file_name)
+                return _md5_checksum(file_name)
+
+            def scan():
+                del hashed[:]
+                with self.open_repository(database) as repo:
+                    DupScanner(repo, hash_function=hash_function).scan((scanned,))
+                    return {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+
+            assert duplicates | removed == scan()
+            assert duplicates | removed == set(hashed)
+
+            assert duplicates | removed == scan()
+            assert not hashed, 'Unchanged files should not be hashed again: {}'.format(hashed)
+
+            with open(modified, 'r+b') as f:
+                # same sample, so it has to be hashed again
+                f.seek(10000)
+                f.write(b'modified')
+            utime(modified, (0, 0))
+            added = test_scenario.copy_file('data/1/a.data', 'data/4/a.data')
+            remove(sorted(removed)[0])
+
+            assert duplicates - {modified} | {added} == scan()
+            assert {modified, added} == set(hashed), 'Only the changed files should be hashed: {}'.format(hashed)
+
+    def test_incremental_scan_algorithm_change(self):
+        with DataGenerator() as test_scenario:
+            database = test_scenario.abs_path('index.db')
+            scanned = test_scenario.abs_path('data')
+            test_scenario.create_duplicates(('data/1/a.data', 'data/2/a.data'), size=100)
+
+            def scan(hash_function):
+                with self.open_repository(database) as repo:
+                    DupScanner(repo, hash_function=hash_function).scan((scanned,))
+                    return {hash for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+
+            md5 = scan(checksum('md5'))
+            sha1 = scan(checksum('sha1'))
+            assert len(md5) == 1 and len(sha1) == 1 and md5 != sha1, \
+                'Hashes were mixed between algorithms: {} {}'.format(md5, sha1)
+
+    def test_incremental_walker(self):
+        with DataGenerator() as test_scenario:
+            database = test_scenario.abs_path('index.db')
+            scanned = test_scenario.abs_path('data')
+            duplicates = test_scenario.create_duplicates(('data/1/a.data', 'data/2/a.data'), size=100)
+            test_scenario.create_file('data/2/3/b.data', size=200)
+
+            def scan():
+                with self.open_repository(database) as repo, \
+                        patch('dupscanner.scandir', wraps=scandir) as listed:
+                    DupScanner(repo, get_files=incremental_walker(repo)).scan((scanned,))
+                    found = {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+                    return found, sorted(path.abspath(call[0][0]) for call in listed.call_args_list)
+
+            # directories modified within the racy window are listed again
+            for dirname in ('data', 'data/1', 'data/2', 'data/2/3'):
+                utime(test_scenario.abs_path(dirname), (0, 0))
+            assert (duplicates, [scanned, scanned + '/1', scanned + '/2', scanned + '/2/3']) == scan()
+
+            found, listed = scan()
+            assert duplicates == found
+            assert not listed, 'Unchanged directories should not be listed again: {}'.format(listed)
+
+            added = test_scenario.copy_file('data/1/a.data', 'data/2/3/a.data')
+            utime(test_scenario.abs_path('data/2/3'), (1, 1))
+            found, listed = scan()
+            assert duplicates | {added} == found
+            assert [scanned + '/2/3'] == listed
+
+            # modified in place, the directory doesn't change
+            with open(added, 'r+b') as f:
+                f.write(b'modified')
+            utime(added, (0, 0))
+            found, listed = scan()
+            assert duplicates == found
+            assert not listed
+
+    def test_hardlinks(self):
+        with DataGenerator() as test_scenario:
+            database = test_scenario.abs_path('index.db')
+            scanned = test_scenario.abs_path('data')
+            copies = test_scenario.create_duplicates(('data/1/a.data', 'data/2/a.data'), size=20000)
+            original = test_scenario.create_file('data/1/b.data', size=20000)
+            hardlinks = {original}
+            for name in ('data/2/b.data', 'data/3/b.data'):
+                test_scenario._mkdirs(path.dirname(name))
+                hardlinks.add(test_scenario.abs_path(name))
+                link(original, test_scenario.abs_path(name))
+
+            hashed = []
+
+            def hash_function(file_name):
+                hashed.append(file_name)
+                return _md5_checksum(file_name)
+
+            def scan(skip_hardlinks):
+                del hashed[:]
+                with self.open_repository(database) as repo:
+                    return {abspath for hash, size, fullname, path, abspath in
+                            DupScanner(repo, hash_function=hash_function).find_duplicates((scanned,), skip_hardlinks)}
+
+            assert copies | hardlinks == scan(False)
+            assert 3 == len(hashed), 'Every inode should be hashed once: {}'.format(hashed)
+
+            # a new hardlink gets the hash of the indexed ones
+            test_scenario._mkdirs('data/4')
+            link(original, test_scenario.abs_path('data/4/b.data'))
+            assert copies == scan(True)
+            assert not hashed, 'Hardlinks of a hashed inode should not be hashed: {}'.format(hashed)
+
+    def test_pipelined_scan(self):
+        with DataGenerator() as test_scenario:
+            duplicates_expected = set()
+            for d in range(6):
+                duplicates_expected |= test_scenario.create_duplicates(
+                    ['%s/%s.data' % (root, d) for root in range(1 + d % 3)], size=1000 * d)
+            duplicates_expected -= {test_scenario.abs_path('0/0.data'), test_scenario.abs_path('0/3.data')}
+            # same size and different contents, discarded by their samples
+            uniques_expected = {test_scenario.create_file('3/%s.data' % d, size=9000) for d in range(3)}
+            uniques_expected |= {test_scenario.abs_path('0/0.data'), test_scenario.abs_path('0/3.data')}
+
+            for workers in (1, 3):
+                lock = threading.Lock()
+                hashed = []
+                sampled = []
+
+                def hash_function(file_name):
+                    with lock:
+                        hashed.append(file_name)
+                    return _md5_checksum(file_name)
+
+                def sample_function(file_name, sample_size):
+                    with lock:
+                        sampled.append(file_name)
+                    return _sample_checksum(file_name, sample_size)
+
+                with self.open_repository(':memory:') as repo:
+                    DupScanner(
+                        repo, hash_function=hash_function, sample_function=sample_function, workers=workers,
+                        max_inflight_bytes=5000, pipeline=True
+                    ).scan((test_scenario.root_path,))
+
+                    duplicates_found = {abspath for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+                    uniques_found = {abspath for hash, size, fullname, path, abspath in repo.findBy_unique_hash()}
+
+                assert duplicates_expected == duplicates_found
+                assert uniques_expected == uniques_found
+                assert sorted(set(hashed)) == sorted(hashed), 'Files were hashed more than once: {}'.format(hashed)
+                assert sorted(set(sampled)) == sorted(sampled), 'Files were sampled more than once: {}'.format(sampled)
+                assert not uniques_expected & set(hashed), 'Unique files were hashed: {}'.format(hashed)
+
+    def test_iter_clusters(self):
+        with DataGenerator() as test_scenario:
+            duplicates_expected = {}
+            for d in range(3):
+                copies = test_scenario.create_duplicates(['%s/%s.data' % (root, d) for root in range(2 + d)], size=1000 + d)
+                duplicates_expected[1000 + d] = tuple(sorted(copies))
+            test_scenario.create_file('0/unique.data', size=1000)
+
+            hashed = []
+
+            def hash_function(file_name):
+                hashed.append(file_name)
+                return _md5_checksum(file_name)
+
+            with self.open_repository(':memory:') as repo:
+                clusters = DupScanner(repo, hash_function=hash_function).iter_clusters((test_scenario.root_path,))
+
+                first = next(clusters)
+                assert len(hashed) < 10, 'The first cluster should be yielded before the scan is over'
+                assert 2 <= len(first.paths) and set(first.paths) <= set(duplicates_expected[first.size])
+
+                clusters_found = {first.size: first}
+                for found in clusters:
+                    # a cluster grows, it never loses files
+                    assert set(clusters_found.get(found.size, found).paths) <= set(found.paths)
+                    clusters_found[found.size] = found
+
+                assert duplicates_expected == {size: found.paths for size, found in clusters_found.items()}
+                for found in clusters_found.values():
+                    assert {found.hash} == {row['hash'] for row in found.files}
+                    self.assertRaises(AttributeError, setattr, found, 'hash', None)
+
+    def test_savings_order(self):
+        with DataGenerator() as test_scenario:
+            # (files - 1) * size: 5000, 6000 and 2000 bytes
+            test_scenario.create_duplicates(['%s/a.data' % root for root in range(2)], size=5000)
+            test_scenario.create_duplicates(['%s/b.data' % root for root in range(4)], size=2000)
+            test_scenario.create_duplicates(['%s/c.data' % root for root in range(3)], size=1000)
+
+            hashed = []
+
+            def hash_function(file_name):
+                hashed.append(path.getsize(file_name))
+                return _md5_checksum(file_name)
+
+            with self.open_repository(':memory:') as repo:
+                scanner = DupScanner(repo, hash_function=hash_function, sample_function=None, deadline=time.monotonic())
+                scanner.scan((test_scenario.root_path,))
+                assert not hashed, 'Files were hashed after the deadline: {}'.format(hashed)
+                assert not list(repo.findBy_duplicate_hash())
+
+                # the next scan hashes the files left
+                scanner.deadline = None
+                scanner.scan((test_scenario.root_path,))
+                assert [2000] * 4 + [5000] * 2 + [1000] * 3 == hashed
+                assert 9 == len(list(repo.findBy_duplicate_hash()))
+
+    def test_compare_small_groups(self):
+        with DataGenerator() as test_scenario:
+            database = test_scenario.abs_path('index.db')
+            scanned = test_scenario.abs_path('data')
+            pair = test_scenario.create_duplicates(('data/1/a.data', 'data/2/a.data'), size=20000)
+            # same size, differ in their last byte
+            different = {test_scenario.create_file('data/%s/b.data' % d, size=30000) for d in range(2)}
+            bigger = test_scenario.create_duplicates(['data/%s/c.data' % d for d in range(4)], size=1000)
+
+            hashed = []
+
+            def hash_function(file_name):
+                hashed.append(file_name)
+                return _md5_checksum(file_name)
+
+            def scan():
+                del hashed[:]
+                with self.open_repository(database) as repo:
+                    DupScanner(repo, hash_function=hash_function, compare_max_files=3).scan((scanned,))
+                    return {abspath: hash for hash, size, fullname, path, abspath in repo.findBy_duplicate_hash()}
+
+            found = scan()
+            assert pair | bigger == set(found)
+            assert bigger == set(hashed), 'Only the big group should be hashed: {}'.format(hashed)
+            assert {'compared-0'} == {found[name] for name in pair}
+
+            # a file joins the pair, it is compared again with the group
+            added = test_scenario.copy_file('data/1/a.data', 'data/3/a.data')
+            found = scan()
+            assert pair | bigger | {added} == set(found)
+            assert not hashed
+
+            # too many files to compare, they are hashed
+            more = {test_scenario.copy_file('data/1/a.data', 'data/%s/a.data' % d) for d in range(4, 6)}
+            found = scan()
+            assert pair | bigger | {added} | more == set(found)
+            assert pair | {added} | more == set(hashed)
+            assert {_md5_checksum(added)} == {found[name] for name in pair}
+
+class TestMemoryRepository(TestRepository):
+
+    backend = 'memory'
+
+    def setUp(self):
+        # a database opened again gets the files indexed by the previous
+        # repository, like a SQLite file
+        self.repositories = {}
+
+    @contextmanager
+    def open_repository(self, database):
+        if database == ':memory:':
+            repo = memory_repository()
+        else:
+            repo = self.repositories.setdefault(database, memory_repository())
+        with repo:
+            yield repo
+
 
 # escenario por probar: link a un link
 
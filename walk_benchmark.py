@@ -0,0 +1,65 @@
+#! /usr/bin/env python
+# Compares the os.walk based walker with the scandir based one.
+#
+#   python walk_benchmark.py --dirs 200 --files 100
+#   python walk_benchmark.py --path /mnt/share
+from __future__ import print_function
+
+import os
+import shutil
+import argparse
+import tempfile
+from timeit import default_timer
+
+from dupscanner import _get_files, _scandir_files, parallel_walker
+
+WALKERS = (
+    ('os.walk', _get_files),
+    ('scandir', _scandir_files),
+    ('8 threads', parallel_walker(threads=8)),
+)
+
+
+def create_tree(root, dirs, files):
+    for d in range(dirs):
+        dirname = os.path.join(root, str(d % 10), str(d))
+        os.makedirs(dirname)
+        for f in range(files):
+            with open(os.path.join(dirname, '%s.data' % f), 'wb') as data:
+                data.write(b'x' * (f % 7))
+
+
+def run(walker, path, repeat):
+    best = None
+    count = 0
+    for _ in range(repeat):
+        start = default_timer()
+        count = sum(1 for _ in walker(path))
+        elapsed = default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return count, best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--path", help="Walk an existing directory instead of a generated tree")
+    parser.add_argument("--dirs", help="Directories in the generated tree", type=int, default=100)
+    parser.add_argument("--files", help="Files per generated directory", type=int, default=100)
+    parser.add_argument("--repeat", help="Runs per walker, the best one is reported", type=int, default=3)
+    args = parser.parse_args()
+
+    root = args.path or tempfile.mkdtemp(prefix='walk_benchmark-')
+    try:
+        if not args.path:
+            create_tree(root, args.dirs, args.files)
+
+        for name, walker in WALKERS:
+            count, elapsed = run(walker, root, args.repeat)
+            print('%-10s %10d files %10.3fs %12.0f files/s' % (name, count, elapsed, count / elapsed))
+    finally:
+        if not args.path:
+            shutil.rmtree(root)
+
+
+if '__main__' == __name__:
+    main()
@@ -1,4 +1,4 @@
-from server import Server, create_server
+from .server import Server, create_server
 
 __all__ = ['Server', 'create_server']
 
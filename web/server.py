@@ -1,6 +1,12 @@
+#python 2 compatibility
+from __future__ import print_function
+
 #from bottle import run as run_bottle, request#, get, route #, post, delete
+import json
 import bottle
 
+from checksums import hexdigest, parse_digest
+
 def get(route):
   def decorator(f):
     f.get = route
@@ -14,8 +20,10 @@ def delete(route):
   return decorator
 
 class Server():
-  def __init__(self, repo):
+  def __init__(self, repo, clusters=None):
     self.repo = repo
+    # DupScanner.iter_clusters of a scan in progress, see stream_clusters
+    self.clusters = clusters
     self.run = bottle.run
 
   @get('/clusters/')
@@ -34,8 +42,8 @@ class Server():
       '_embedded': {
         'clusters' : [
           {
-            '_links': {'self': {'href':'/{}/{}'.format(hash, size)} },
-            'hash':hash, 
+            '_links': {'self': {'href':'/{}/{}'.format(hexdigest(hash), size)} },
+            'hash':hexdigest(hash), 
             'size':size, 
             'count':count
           }
@@ -45,6 +53,26 @@ class Server():
       }
     }
 
+  @get('/clusters/stream')
+  def stream_clusters(self):
+    # One JSON document per line, sent as soon as a cluster is confirmed,
+    # and again every time it grows. The scan runs while the response is read
+    if self.clusters is None:
+      bottle.abort(404, 'There is no scan in progress')
+    bottle.response.content_type = 'application/x-ndjson'
+
+    clusters, self.clusters = self.clusters, None
+    return (
+      json.dumps({
+        '_links': {'self': {'href':'/clusters/{}/{}'.format(hexdigest(found.hash), found.size)}},
+        'hash': hexdigest(found.hash),
+        'size': found.size,
+        'count': len(found.files),
+        'files': found.paths
+      }) + '\n'
+      for found in clusters
+    )
+
   @get('/clusters/<hash>/<size>')
   def get_cluster(self, hash, size):
     return {
@@ -60,27 +88,27 @@ class Server():
             },
             'fullname': fullname,
             'size': file_size,
-            'hash': file_hash,
+            'hash': hexdigest(file_hash),
             'path': path,
             'abspath': abspath,
             'realpath': realpath
           }
           for fullname, file_size, file_hash, path, abspath, realpath
-          in self.repo.findBy_hash_size(hash, size)
+          in self.repo.findBy_hash_size(parse_digest(hash), int(size))
         ]
       }
     }
 
   @get('/files/<abspath:path>')
   def get_file(self, abspath):
-    print abspath
+    print(abspath)
 
   @delete('/files/<abspath:path>')
   def delete_file(self, abspath):
     try:
       self.repo.delete_file(abspath)
     except Exception as e:
-      print "EEEE: ", str(e)
+      print("EEEE: ", str(e))
       bottle.response.status = str(e)
 
 def routeapp(server):
@@ -89,18 +117,18 @@ def routeapp(server):
     # print "kw: ", kw
     attr = getattr(server, kw)
     if hasattr(attr, 'get'):
-      print "- attr: ", attr
-      print "- attr.get: ", attr.get
+      print("- attr: ", attr)
+      print("- attr.get: ", attr.get)
       # traceback.print_exc()
       bottle.get(attr.get)(attr)
     if hasattr(attr, 'delete'):
-      print "- attr: ", attr
-      print "- attr.delete: ", attr.delete
+      print("- attr: ", attr)
+      print("- attr.delete: ", attr.delete)
       # traceback.print_exc()
       bottle.delete(attr.delete)(attr)
 
-def create_server(repo):
-  server = Server(repo)
+def create_server(repo, clusters=None):
+  server = Server(repo, clusters)
   routeapp(server)
 
   return server
\ No newline at end of file